@@ -1,15 +1,50 @@
-from tempfile import TemporaryFile
+from importlib.util import find_spec
 
 import numpy as np
-import richdem as rd
+
+import instrument
+
+BACKENDS = ('richdem', 'numpy')
+
+def have_richdem():
+    '''
+    whether the richdem backend is installed, without importing it;
+    richdem itself is only imported when that backend is used.
+    '''
+    return find_spec('richdem') is not None
 
 class Attributes():
 
-    def __init__(self, grid, resolution, projection, side_len):
+    def __init__(self, grid, resolution, projection, side_len,
+                 backend='richdem', dtype=None):
+        '''
+        Parameters
+        ==========
+        backend : str
+            'richdem' computes slope and aspect with rd.TerrainAttribute;
+            'numpy' uses the equivalent Horn (1981) stencil implemented
+            directly on NumPy arrays, without the richdem dependency.
+        dtype : str or np.dtype, optional
+            dtype of the returned grids; both backends return float32
+            by default. The stencil itself always runs on the DEM's own
+            precision, since neighbouring elevations can differ by less
+            than float32 resolves at typical absolute heights.
+        '''
+        if backend not in BACKENDS:
+            raise ValueError(
+                f'unknown attribute backend {backend!r}, '
+                f'expected one of {BACKENDS}'
+            )
         self.grid = grid
         self.resolution = resolution
         self.projection = projection
         self.side_len = side_len
+        self.backend = backend
+        self.dtype = dtype
+
+    @property
+    def cell_scale(self):
+        return np.around(a=self.side_len/self.resolution, decimals=5)
 
     def _numpy2richdem(self, in_array, no_data=-9999):
         '''
@@ -17,10 +52,11 @@ class Attributes():
         requires data in rdarray format. this function converts numpy
         arrays into rdarrays.
         '''
+        import richdem as rd
+
         out_array = rd.rdarray(in_array, no_data=no_data)
         out_array.projection = self.projection
-        cell_scale = np.around(a=self.side_len/self.resolution, decimals=5)
-        out_array.geotransform = [0, cell_scale, 0, 0, 0, cell_scale]
+        out_array.geotransform = [0, self.cell_scale, 0, 0, 0, self.cell_scale]
         return out_array
 
     @staticmethod
@@ -31,26 +67,92 @@ class Attributes():
         in_array : richdem array
 
         attribute : str
-            One of 'slope
+            One of 'slope_radians' or 'aspect'
+
+        rdarray is an ndarray subclass, so the result is returned as a
+        plain ndarray view of richdem's buffer, without copying. Aspects
+        greater than 180 are wrapped to negative values in place.
         '''
-        outfile = TemporaryFile()
-        np.save(outfile, rd.TerrainAttribute(rda, attrib=attribute))
-        _ = outfile.seek(0)
-        out_array = np.load(outfile)
+        import richdem as rd
+
+        out_array = rd.TerrainAttribute(rda, attrib=attribute).view(np.ndarray)
 
         if attribute == 'aspect':
-            out_array[out_array>180] = out_array[out_array>180]-360
+            np.subtract(out_array, 360, out=out_array, where=out_array>180)
             return out_array
         else:
             return out_array
 
+    def _horn_gradients(self, in_array, no_data=-9999):
+        '''
+        dz/dx and dz/dy from the Horn (1981) 3x3 stencil, with neighbours
+        labelled
+
+            a b c
+            d e f
+            g h i
+
+        As in richdem, neighbours that fall outside the grid or are
+        nodata take the value of the central cell e.
+        '''
+        e = np.asarray(in_array, dtype=np.float64)
+        padded = np.pad(e, 1, mode='constant', constant_values=np.nan)
+        padded[1:-1, 1:-1][e == no_data] = np.nan
+
+        rows, cols = e.shape
+        def neighbour(dy, dx):
+            n = padded[1+dy:1+dy+rows, 1+dx:1+dx+cols]
+            return np.where(np.isnan(n), e, n)
+
+        a, b, c = neighbour(-1, -1), neighbour(-1, 0), neighbour(-1, 1)
+        d, f = neighbour(0, -1), neighbour(0, 1)
+        g, h, i = neighbour(1, -1), neighbour(1, 0), neighbour(1, 1)
+
+        dzdx = ((c + 2*f + i) - (a + 2*d + g)) / 8 / self.cell_scale
+        dzdy = ((g + 2*h + i) - (a + 2*b + c)) / 8 / self.cell_scale
+        return dzdx, dzdy
+
+    def _calc_attributes_numpy(self, in_array, no_data=-9999):
+        '''
+        slope (radians) and aspect (degrees, wrapped as in
+        _richdem2numpy) computed without richdem. Matches richdem's
+        output dtype (float32), flat-cell aspect (-1) and nodata cells.
+        '''
+        dzdx, dzdy = self._horn_gradients(in_array, no_data)
+
+        slope = np.arctan(np.hypot(dzdx, dzdy))
+
+        aspect = np.rad2deg(np.arctan2(dzdy, -dzdx))
+        aspect = np.where(
+            aspect < 0, 90 - aspect,
+            np.where(aspect > 90, 450 - aspect, 90 - aspect)
+        )
+        aspect[(dzdx == 0) & (dzdy == 0)] = -1
+        np.subtract(aspect, 360, out=aspect, where=aspect>180)
+
+        nodata = np.asarray(in_array) == no_data
+        slope[nodata] = no_data
+        aspect[nodata] = no_data
+
+        return slope.astype(np.float32), aspect.astype(np.float32)
+
+    @instrument.timed('attributes')
     def calc_attributes(self):
         '''
         given input grid, returns slope and aspect grids
         '''
-        rda = self._numpy2richdem(np.asarray(self.grid), -9999)
+        if self.backend == 'numpy':
+            slope, aspect = self._calc_attributes_numpy(
+                np.asarray(self.grid), -9999
+            )
+        else:
+            rda = self._numpy2richdem(np.asarray(self.grid), -9999)
+
+            slope = self._richdem2numpy(rda=rda, attribute='slope_radians')
+            aspect = self._richdem2numpy(rda=rda, attribute='aspect')
 
-        slope = self._richdem2numpy(rda=rda, attribute='slope_radians')
-        aspect = self._richdem2numpy(rda=rda, attribute='aspect')
+        if self.dtype is not None:
+            slope = slope.astype(self.dtype, copy=False)
+            aspect = aspect.astype(self.dtype, copy=False)
 
         return slope, aspect
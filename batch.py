@@ -0,0 +1,244 @@
+'''
+Headless batch processing of a directory of DEMs:
+
+    python batch.py DATA_DIR OUT_DIR [--start YYYY-MM-DD --end YYYY-MM-DD]
+                                     [--workers N] [--mode MODE]
+                                     [--quantize QUANTIZE] [--compact]
+                                     [--conf FILE]
+
+Each (DEM, date) pair is one job, run on a process pool, writing
+OUT_DIR/<DEM>_<YYYYMMDD>_correction.npz in the format of the app's
+export. Without a date range, each DEM is processed for the date in its
+filename. Outputs that already exist are skipped, so an interrupted run
+resumes where it stopped.
+
+Timesteps are computed as they are written, so a job holds one of them
+at a time rather than the day's stack. DEMs of more than TILE_CELLS
+cells are processed tile by tile (see tiling.TiledCorrection) through
+memory-mapped files next to the output, which are removed afterwards.
+
+Tiling bounds the memory of slope, aspect and the correction stack, not
+of the whole job, which still needs several times the DEM's size in
+RAM (as float64): about 12 times while horizons are computed, one
+azimuth at a time, and about 9 times with --compact, or 11 times with
+aggregates, whose valid cells and bases span the whole grid. It is not
+a way to process DEMs larger than RAM.
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, timedelta
+from multiprocessing import util
+
+import numpy as np
+
+from attributes import Attributes
+from correction import Correction, PreparedTerrain
+from horizon import Horizons
+from cache import shared_cache
+from export import MODES, QUANTIZE, iter_export_chunks
+from tiling import TiledCorrection
+
+def _date_range(start, end):
+    day = date.fromisoformat(start)
+    while day <= date.fromisoformat(end):
+        yield day.strftime('%Y%m%d')
+        day += timedelta(days=1)
+
+def list_jobs(data_dir, out_dir, start=None, end=None):
+    '''
+    Returns (dem_path, date_str, out_path) for every DEM in data_dir and
+    date, leaving out jobs whose output already exists.
+    '''
+    jobs = []
+    for fn in sorted(os.listdir(data_dir)):
+        if not fn.endswith('.npy'):
+            continue
+        dates = list(_date_range(start, end)) if start else [fn[:8]]
+        for date_str in dates:
+            out_path = os.path.join(
+                out_dir, f'{fn[:-4]}_{date_str}_correction.npz'
+            )
+            if not os.path.exists(out_path):
+                jobs.append((os.path.join(data_dir, fn), date_str, out_path))
+    return jobs
+
+def _calc_terrain(dem_path, conf):
+    elevation = np.load(dem_path, mmap_mode='r')
+    attributes = Attributes(
+            elevation,
+            resolution=elevation.shape[0],
+            projection=conf['PROJECTION'],
+            side_len=conf['SIDE_LEN'],
+            backend=conf['ATTRIBUTE_BACKEND'],
+            dtype=conf['DTYPE']
+    )
+    slope, aspect = attributes.calc_attributes()
+    horizons = None
+    if conf['HORIZON_BINS']:
+        cell_size = conf['SIDE_LEN'] / elevation.shape[0]
+        horizons = Horizons(elevation, cell_size,
+                            n_bins=conf['HORIZON_BINS'])
+    # the valid cells, bases and compact horizons are shared by every
+    # date; the full horizons are not needed once compacted
+    terrain = PreparedTerrain(slope, aspect, dtype=conf['DTYPE'],
+                              horizons=horizons)
+    return elevation, slope, aspect, terrain
+
+class _TiledTerrain():
+    '''
+    Slope, aspect and horizons of a DEM processed tile by tile,
+    memory-mapped from a temporary directory that is removed once the
+    instance is collected, or when the worker process exits.
+    '''
+    def __init__(self, tiled, out_dir):
+        self.dir = tempfile.mkdtemp(prefix='.terrain-', dir=out_dir)
+        # unlike weakref.finalize, also run when a pool worker exits
+        util.Finalize(self, shutil.rmtree, args=(self.dir,),
+                      kwargs={'ignore_errors': True}, exitpriority=0)
+        self.terrain = tiled.calc_terrain(self.dir)
+
+# the worker's _TiledTerrain, and its key. Its files take no memory,
+# so rather than in the terrain cache, one DEM's are kept at a time;
+# jobs are listed DEM by DEM, so a worker's successive jobs mostly
+# share them.
+_tiled = (None, None)
+
+def _tiled_correction(dem_path, date_str, conf):
+    return TiledCorrection(
+            dem_path,
+            side_len=conf['SIDE_LEN'],
+            projection=conf['PROJECTION'],
+            local_timezone=conf['TIMEZONE'],
+            date_str=date_str,
+            lat_lon=conf['LAT_LON'],
+            tile_size=conf['TILE_SIZE'],
+            backend=conf['ATTRIBUTE_BACKEND'],
+            sun_backend=conf['SUN_BACKEND'],
+            dtype=conf['DTYPE'],
+            time_step=conf['TIME_STEP'],
+            ephemeris_step=conf['EPHEMERIS_STEP'],
+            horizon_bins=conf['HORIZON_BINS']
+    )
+
+def _tiled_terrain(dem_path, date_str, out_path, conf):
+    '''
+    Returns elevation, slope, aspect, the Correction and the stack for
+    a large DEM, computed tile by tile into memory-mapped files; the
+    stack's directory is returned too, for removal once written.
+    '''
+    global _tiled
+    tiled = _tiled_correction(dem_path, date_str, conf)
+    key = (dem_path, os.path.getmtime(dem_path))
+    if _tiled[0] != key:
+        _tiled = (None, None)
+        _tiled = (key, _TiledTerrain(tiled, os.path.dirname(out_path)))
+    terrain = _tiled[1].terrain
+    stack_dir = out_path + '.tiles'
+    correct = tiled.run(stack_dir, terrain=terrain, time_major=True)
+    slope, aspect, _ = terrain
+    # the stack already holds the shadows; the whole-grid Correction
+    # is only asked for its sun table, valid cells and aggregates
+    correct.horizons = None
+    correct.attribute_grids = (slope, aspect)
+    stack = np.load(os.path.join(stack_dir, 'correction_stack.npy'),
+                    mmap_mode='r')
+    elevation = np.load(dem_path, mmap_mode='r')
+    return elevation, slope, aspect, correct, stack, stack_dir
+
+def run_job(dem_path, date_str, out_path, conf, mode='stack',
+            quantize='none', compact=False):
+    '''
+    Computes and writes one output. Terrain is cached per worker
+    process, so successive dates of one DEM reuse it. The archive is
+    written under a temporary name and renamed when complete, so a
+    killed job never leaves an output that would be skipped on resume.
+    '''
+    shape = np.load(dem_path, mmap_mode='r').shape
+    stack = stack_dir = None
+    if shape[0] * shape[1] > conf['TILE_CELLS']:
+        elevation, slope, aspect, correct, stack, stack_dir = _tiled_terrain(
+                dem_path, date_str, out_path, conf
+        )
+    else:
+        terrain_cache = shared_cache(max_bytes=conf['CACHE_BYTES'])
+        elevation, slope, aspect, terrain = terrain_cache.get_or_compute(
+                ('batch', dem_path, os.path.getmtime(dem_path)),
+                lambda: _calc_terrain(dem_path, conf)
+        )
+        correct = Correction(
+                attribute_grids=(slope, aspect),
+                local_timezone=conf['TIMEZONE'],
+                date_str=date_str,
+                lat_lon=conf['LAT_LON'],
+                sun_backend=conf['SUN_BACKEND'],
+                dtype=conf['DTYPE'],
+                time_step=conf['TIME_STEP'],
+                ephemeris_step=conf['EPHEMERIS_STEP'],
+                terrain=terrain
+        )
+
+    part_path = out_path + '.part'
+    try:
+        with open(part_path, 'wb') as f:
+            for chunk in iter_export_chunks(elevation, slope, aspect, correct,
+                                            stack=stack, mode=mode,
+                                            quantize=quantize,
+                                            compact=compact):
+                f.write(chunk)
+    finally:
+        if stack_dir is not None:
+            shutil.rmtree(stack_dir, ignore_errors=True)
+    os.replace(part_path, out_path)
+    return out_path
+
+def main(argv=None):
+    import config as c
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('data_dir')
+    parser.add_argument('out_dir')
+    parser.add_argument('--start', help='first date, YYYY-MM-DD')
+    parser.add_argument('--end', help='last date, YYYY-MM-DD')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--mode', choices=MODES, default='stack',
+                        help='export mode, see export.iter_export_chunks')
+    parser.add_argument('--conf', help='settings file, see config.load')
+    parser.add_argument('--quantize', choices=tuple(QUANTIZE), default='none',
+                        help='store rasters as 16-bit integers in a '
+                             'compressed archive, see export.quantize')
+    parser.add_argument('--compact', action='store_true',
+                        help='store only the valid cells of each raster, '
+                             'see export.iter_export_chunks')
+    args = parser.parse_args(argv)
+    if args.conf:
+        c.load(args.conf)
+    if bool(args.start) != bool(args.end):
+        parser.error('--start and --end must be given together')
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    jobs = list_jobs(args.data_dir, args.out_dir, args.start, args.end)
+    print(f'{len(jobs)} jobs to run')
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(run_job, *job, c.conf, args.mode, args.quantize,
+                        args.compact): job
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            dem_path, date_str, _ = futures[future]
+            try:
+                print(f'wrote {future.result()}')
+            except Exception as e:
+                failed += 1
+                print(f'failed {dem_path} {date_str}: {e!r}', file=sys.stderr)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
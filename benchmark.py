@@ -0,0 +1,222 @@
+'''
+Benchmarks of each stage of the pipeline over synthetic DEMs:
+
+    python benchmark.py [--sizes N [N ...]] [--repeat R] [--out FILE]
+                        [--baseline FILE] [--tolerance T] [--update-baseline]
+
+For every DEM size, each stage is timed separately (the best of R runs)
+and then run once more under tracemalloc for its peak memory, i.e. the
+most memory allocated above what the stage started with. NumPy reports
+its array buffers to tracemalloc, so this covers the arrays a stage
+creates, but not memory held by compiled libraries such as richdem.
+
+Results are written as JSON to --out. If the --baseline file exists,
+every (stage, size) in both is compared, and the exit status is 1 if
+any stage got slower, or used more memory, by more than the relative
+--tolerance. --update-baseline overwrites the baseline with this run.
+Timings are only comparable on the same machine, so a baseline should
+be recorded on the machine that checks against it.
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+from attributes import Attributes, have_richdem
+from correction import Correction, PreparedTerrain
+from export import iter_export_chunks
+from horizon import Horizons
+
+SIZES = (32, 128, 512, 2048)
+
+# synthetic DEMs share the sample DEM's cell size and location
+CELL_SIZE = 0.01
+DATE_STR = '20190623'
+LAT_LON = (37.643, -119.029)
+TIMEZONE = 'America/Los_Angeles'
+
+# stages that build the (time, rows, cols) stack are skipped for DEMs
+# whose stack would be larger than this
+MAX_STACK_BYTES = 4_000_000_000
+
+# changes smaller than these are timer and allocator noise, whatever
+# their ratio, and are never reported as regressions
+NOISE = {'seconds': 0.002, 'peak_bytes': 2**20}
+
+def synthetic_dem(size, seed=0, relief=0.1):
+    '''
+    A size x size fractal (brown noise) surface with realistic slopes,
+    as float64 elevations around those of the sample DEM.
+
+    Parameters
+    ==========
+    relief : float
+        height range, as a fraction of the DEM's side length
+    '''
+    rng = np.random.default_rng(seed)
+    freqs = np.fft.fftfreq(size)
+    k = np.hypot(freqs[:, np.newaxis], freqs[np.newaxis, :])
+    k[0, 0] = np.inf
+    spectrum = np.fft.fft2(rng.standard_normal((size, size))) / k**2
+    z = np.fft.ifft2(spectrum).real
+    z = (z - z.min()) / (z.max() - z.min())
+    return 2940 + z * relief * size * CELL_SIZE
+
+def _looped_correction(correct):
+    # the per-timestep loop the full-day stack replaced, kept as the
+    # baseline it is measured against
+    n_times = correct.sunposition_df.shape[0]
+    stack = np.empty((*correct.terrain.shape, n_times), dtype=correct.dtype)
+    for i in range(n_times):
+        correct.calc_correction_onetime(i, out=stack[..., i])
+    return stack
+
+def _drain(chunks):
+    return sum(len(chunk) for chunk in chunks)
+
+def _stages(dem):
+    '''
+    Yields (name, func) for every stage, in pipeline order. Each func
+    takes no arguments; the inputs it needs are computed (untimed)
+    before it is yielded.
+    '''
+    side_len = dem.shape[0] * CELL_SIZE
+
+    def attributes(backend):
+        return Attributes(dem, resolution=dem.shape[0], projection='WGS84',
+                          side_len=side_len, backend=backend).calc_attributes()
+
+    yield 'attributes_numpy', lambda: attributes('numpy')
+    if have_richdem():
+        yield 'attributes_richdem', lambda: attributes('richdem')
+    slope, aspect = attributes('numpy')
+
+    yield 'horizons', lambda: Horizons(dem, CELL_SIZE)
+    horizons = Horizons(dem, CELL_SIZE)
+
+    def correction(time_step='15min', **kwargs):
+        return Correction((slope, aspect), TIMEZONE, DATE_STR, LAT_LON,
+                          sun_backend='noaa', time_step=time_step, **kwargs)
+
+    yield 'sunposition', correction
+    yield 'sunposition_1min', lambda: correction('1min')
+    correct = correction(horizons=horizons)
+    n_times = correct.sunposition_df.shape[0]
+
+    yield 'terrain_bases', lambda: PreparedTerrain(slope, aspect)
+    correct.terrain
+    yield 'correction_onetime', lambda: correct.calc_correction_onetime(
+        n_times // 2
+    )
+    yield 'daily_aggregates', correct.calc_daily_aggregates
+
+    if dem.size * n_times * correct.dtype.itemsize > MAX_STACK_BYTES:
+        return
+    yield 'correction_looped', lambda: _looped_correction(correct)
+    yield 'correction_fullday', correct.calc_correction_fullday
+    yield 'export', lambda: _drain(
+        iter_export_chunks(dem, slope, aspect, correct)
+    )
+    yield 'export_quantized', lambda: _drain(
+        iter_export_chunks(dem, slope, aspect, correct, quantize='stack')
+    )
+
+def _measure(func, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        func()
+        peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes
+    finally:
+        tracemalloc.stop()
+    return min(seconds), peak_bytes
+
+def run(sizes=SIZES, repeat=3, log=print):
+    '''
+    Runs every stage on a synthetic DEM of each size, returning the
+    results as a JSON-serializable dict.
+    '''
+    results = []
+    for size in sizes:
+        dem = synthetic_dem(size)
+        for stage, func in _stages(dem):
+            seconds, peak_bytes = _measure(func, repeat)
+            results.append({'stage': stage, 'size': size,
+                            'seconds': seconds, 'peak_bytes': peak_bytes})
+            log(f'{stage:>20} {size:>6} {seconds:10.4f} s '
+                f'{peak_bytes/2**20:10.1f} MiB')
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+def compare(results, baseline, tolerance=0.25):
+    '''
+    Returns (stage, size, metric, ratio) for every stage and size in
+    both results and baseline whose seconds or peak_bytes grew by more
+    than the relative tolerance (and by more than NOISE).
+    '''
+    base = {(r['stage'], r['size']): r for r in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        key = (result['stage'], result['size'])
+        if key not in base:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            old, new = base[key][metric], result[metric]
+            if new - old <= NOISE[metric]:
+                continue
+            ratio = new / old if old > 0 else np.inf
+            if ratio > 1 + tolerance:
+                regressions.append((*key, metric, ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='side lengths, in cells, of the synthetic DEMs')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.repeat)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    status = 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for stage, size, metric, ratio in regressions:
+            print(f'regression: {stage} at {size} cells, '
+                  f'{metric} x{ratio:.2f}', file=sys.stderr)
+        status = 1 if regressions else 0
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+def content_hash(array):
+    '''
+    returns a hex digest of an array's dtype, shape and contents, for
+    use as a cache key that is independent of the DEM's filename.
+    '''
+    array = np.ascontiguousarray(array)
+    h = hashlib.sha1()
+    h.update(str(array.dtype).encode())
+    h.update(str(array.shape).encode())
+    h.update(array.data)
+    return h.hexdigest()
+
+def nbytes(value, _seen=None):
+    '''
+    Estimates the memory held by a cached value: the sum of the
+    ndarrays and DataFrames it contains, directly or through tuples,
+    lists, dicts and object attributes. Objects reachable twice are
+    counted once, as is an array reachable through several views, which
+    keep the whole of it alive. Memory-mapped arrays count as zero,
+    since the page cache rather than the process holds them.
+    '''
+    seen = set() if _seen is None else _seen
+    if isinstance(value, np.ndarray):
+        while isinstance(value.base, np.ndarray):
+            value = value.base
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if hasattr(value, 'memory_usage'):
+        return int(value.memory_usage(index=True).sum())
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v, seen) for v in value)
+    if isinstance(value, dict):
+        return sum(nbytes(v, seen) for v in value.values())
+    if hasattr(value, '__dict__'):
+        return sum(nbytes(v, seen) for v in vars(value).values())
+    return 0
+
+class _Pending():
+    '''
+    a computation in progress in LRUCache.get_or_compute, and its
+    result once done.
+    '''
+    def __init__(self):
+        self.event = threading.Event()
+        self.done = False
+        self.value = None
+
+class LRUCache():
+    '''
+    A thread-safe mapping that evicts its least recently used entries
+    once it holds more than maxsize entries or more than max_bytes (as
+    estimated by nbytes). Either limit may be None.
+
+    get_or_compute deduplicates concurrent misses: while one thread
+    computes a key, other threads asking for it wait for that result
+    rather than computing it again.
+
+    A value's size is measured when it is stored, so values that build
+    parts of themselves lazily should build them first. Objects that a
+    value shares with other entries, such as the Horizons of a DEM
+    referenced by each of its terrain entries, can be left out of its
+    size by passing them as shared.
+    '''
+    def __init__(self, maxsize=None, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def _over_budget(self):
+        return (
+            (self.maxsize is not None and len(self._data) > self.maxsize)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        )
+
+    def _pop(self, key):
+        del self._data[key]
+        self._bytes -= self._sizes.pop(key)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value, shared=()):
+        '''
+        stores value, evicting older entries as needed. A value too
+        large for max_bytes on its own is not stored. Memory reachable
+        from the objects in shared is not counted towards its size.
+        '''
+        seen = set()
+        nbytes(shared, seen)
+        size = nbytes(value, seen)
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = value
+            self._sizes[key] = size
+            self._bytes += size
+            while self._over_budget():
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+
+    def get_or_compute(self, key, func, shared=()):
+        '''
+        returns the cached value for key, calling func() and caching its
+        result (see put) on a miss. Threads that waited for the result
+        get it even if it was too large to store.
+        '''
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            pending = self._pending.get(key)
+            if pending is None:
+                self.misses += 1
+                pending = self._pending[key] = _Pending()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            pending.event.wait()
+            if pending.done:
+                with self._lock:
+                    self.hits += 1
+                return pending.value
+            # the computation failed; try it again
+            return self.get_or_compute(key, func, shared)
+
+        try:
+            value = func()
+            self.put(key, value, shared)
+            pending.value, pending.done = value, True
+        finally:
+            with self._lock:
+                self._pending.pop(key).event.set()
+        return value
+
+    def stats(self):
+        '''
+        returns a dict of the cache's counters and current size.
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def shared_cache(max_bytes=None):
+    '''
+    Returns the process-wide LRUCache, creating it with max_bytes on
+    the first call. Every Panel session served by the process shares
+    it, so a DEM opened by many users is loaded and processed once.
+    '''
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = LRUCache(max_bytes=max_bytes)
+        return _shared_cache
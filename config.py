@@ -1,8 +1,49 @@
-import toml
+'''
+Settings from conf.toml, read on first access, e.g. config.SIDE_LEN;
+config.conf is the whole file as a dict. The file is the path given to
+load(), else the one named by the UFUNC_CORRECT_CONF environment
+variable, else the conf.toml next to this module.
+'''
+import os
 
-conf = toml.load('ufunc-correct/conf.toml')
+ENV_VAR = 'UFUNC_CORRECT_CONF'
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'conf.toml')
 
-locals().update(conf)
+_settings = None
 
-BOUNDS = [*EAST_BOUNDS, *NORTH_BOUNDS, *ELEV_BOUNDS]
-EAST_MIN, EAST_MAX, NORTH_MIN, NORTH_MAX, ELEV_MIN, ELEV_MAX = BOUNDS
+def _read_toml(path):
+    try:
+        import tomllib
+    except ImportError:
+        import toml
+        return toml.load(path)
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+def load(path=None):
+    '''
+    (Re)loads the settings from path, or from the default location
+    described above, and returns them as a dict.
+    '''
+    global _settings
+    conf = _read_toml(path or os.environ.get(ENV_VAR, DEFAULT_PATH))
+
+    bounds = [*conf['EAST_BOUNDS'], *conf['NORTH_BOUNDS'], *conf['ELEV_BOUNDS']]
+    _settings = dict(conf, conf=conf, BOUNDS=bounds)
+    _settings.update(zip(
+        ('EAST_MIN', 'EAST_MAX', 'NORTH_MIN', 'NORTH_MAX',
+         'ELEV_MIN', 'ELEV_MAX'),
+        bounds
+    ))
+    return conf
+
+def __getattr__(name):
+    if name.startswith('__'):
+        raise AttributeError(name)
+    if _settings is None:
+        load()
+    try:
+        return _settings[name]
+    except KeyError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,11 +1,193 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import pandas as pd
-from pysolar import solar
+
+import instrument
+import sunposition
+
+# pandas is imported by the methods that build the sun table, so that
+# importing this module needs only NumPy
+
+AGGREGATES = ('sum', 'mean', 'max', 'weighted_sum', 'weighted_mean')
+
+class PreparedTerrain():
+    '''
+    Expanding cos(P0 - A) = cosP0*cosA + sinP0*sinA, the correction
+
+        cosT/cosT0 = cosS + tanT0*cosP0*(sinS*cosA) + tanT0*sinP0*(sinS*sinA)
+
+    is a linear combination of three per-cell terrain bases with
+    per-timestep scalar coefficients. The bases (and all of the grid's
+    transcendental work) are computed once here; a full day is then a
+    single (time x 3) . (3 x cells) matrix product, with the division by
+    cosT0 folded into the coefficients.
+
+    With dtype float32, the bases, coefficients and output are float32.
+    Each output cell is then a three-term sum of float32 products, so
+    its absolute error against float64 is bounded by about
+    4*eps32*(1 + 2*tanT0), where eps32 = 1.2e-7: below 1e-6 for solar
+    zenith angles under 60 degrees, and 5e-5 at a zenith of 89 degrees.
+
+    Cells whose slope or aspect is no_data (or not finite) are left out:
+    the bases, and every correction computed from them, hold only the
+    valid cells, in row-major order, so that work and memory scale with
+    the valid area rather than the bounding box. scatter expands them
+    into full rasters, with no_data in the invalid cells. When every
+    cell is valid, valid is None and scatter is a reshape.
+
+    Given the DEM's Horizons, self.horizons holds them compressed to the
+    valid cells too. None of this depends on the date, so one instance
+    can be shared by the Corrections of every date of a DEM.
+    '''
+    def __init__(self, slope, aspect, dtype=np.float64, no_data=-9999,
+                 horizons=None):
+        self.dtype = np.dtype(dtype)
+        self.no_data = no_data
+        slope, aspect = np.asarray(slope), np.asarray(aspect)
+        self.shape = slope.shape
+
+        with instrument.stage('terrain_bases') as stage:
+            valid = (
+                np.isfinite(slope) & np.isfinite(aspect)
+                & (slope != no_data) & (aspect != no_data)
+            )
+            if valid.all():
+                self.valid = None
+                slope, aspect = slope.reshape(-1), aspect.reshape(-1)
+            else:
+                self.valid = valid
+                self._invalid = ~valid
+                self._index = np.flatnonzero(valid)
+                slope, aspect = slope[valid], aspect[valid]
+
+            S = np.deg2rad(slope.astype(self.dtype))
+            A = np.deg2rad(aspect.astype(self.dtype))
+            sinS = np.sin(S)
+            self.bases = np.stack(
+                (np.cos(S), sinS*np.cos(A), sinS*np.sin(A))
+            )
+            self.horizons = (None if horizons is None
+                             else horizons.compress(self.valid))
+            stage.nbytes = self.bases.nbytes
+
+    @property
+    def n_cells(self):
+        '''
+        number of valid cells, i.e. the length of the compact axis.
+        '''
+        return self.bases.shape[1]
+
+    @property
+    def index(self):
+        '''
+        flat (row-major) indices of the valid cells in the full raster.
+        '''
+        if self.valid is None:
+            return np.arange(self.n_cells)
+        return self._index
+
+    def compress(self, raster):
+        '''
+        the valid cells of a (..., rows, cols) raster, as (..., cells).
+        '''
+        raster = np.asarray(raster)
+        if self.valid is None:
+            return raster.reshape(*raster.shape[:-2], -1)
+        return raster[..., self.valid]
+
+    def compact_view(self, out):
+        '''
+        out, a (..., rows, cols) raster, as a (..., cells) view that
+        corrections can be written into directly, or None if there is
+        no such view (some cells are invalid, or out is not contiguous
+        over its cells).
+        '''
+        if self.valid is not None or out is None:
+            return None
+        view = out.view()
+        try:
+            view.shape = (*out.shape[:-2], self.n_cells)
+        except AttributeError:
+            return None
+        return view
+
+    def scatter(self, compact, out=None):
+        '''
+        expands compact (..., cells) values into (..., rows, cols)
+        rasters with no_data in the invalid cells, written into out if
+        given (which may be a non-contiguous view). Nothing is copied
+        if compact is already a view of out from self.compact_view.
+        '''
+        if out is None:
+            if self.valid is None:
+                return compact.reshape(*compact.shape[:-1], *self.shape)
+            out = np.empty((*compact.shape[:-1], *self.shape),
+                           dtype=compact.dtype)
+        if self.valid is None:
+            if not np.shares_memory(compact, out):
+                out[...] = compact.reshape(out.shape)
+            return out
+        if out.flags.c_contiguous:
+            # filling and indexing the flattened cells is several times
+            # faster than two boolean-mask assignments
+            flat = out.reshape(*out.shape[:-2], -1)
+            flat.fill(self.no_data)
+            flat[..., self.index] = compact
+            return out
+        out[..., self._invalid] = self.no_data
+        out[..., self.valid] = compact
+        return out
+
+    def coefficients(self, T0, P0):
+        '''
+        Parameters
+        ==========
+        T0, P0 : array-like, length == time
+            solar zenith and azimuth (south = 0, east positive), radians
+
+        Returns
+        =======
+        ndarray, shape == (time, 3)
+        '''
+        tanT0 = np.tan(T0)
+        coeffs = np.column_stack(
+            (np.ones_like(tanT0), tanT0*np.cos(P0), tanT0*np.sin(P0))
+        )
+        return coeffs.astype(self.dtype)
+
+    def correction(self, coeffs, out=None):
+        '''
+        returns the compact (time, cells) corrections for an array of
+        coefficients from self.coefficients, written into out (a
+        C-contiguous array of that shape) if given.
+        '''
+        if out is None:
+            out = np.empty((len(coeffs), self.n_cells), dtype=self.dtype)
+        np.matmul(coeffs, self.bases, out=out)
+        return out
+
+    def correction_onetime(self, coeffs, out=None):
+        '''
+        returns the compact (cells,) correction for a single row of
+        coefficients, written into out if given.
+        '''
+        c0, c1, c2 = coeffs
+        out = np.multiply(self.bases[1], c1, out=out)
+        out += self.bases[2]*c2
+        out += self.bases[0]*c0
+        return out
 
 class Correction():
     '''
     '''
-    def __init__(self, attribute_grids, local_timezone, date_str, lat_lon):
+    # timesteps per block of calc_correction_fullday; fixed, rather than
+    # derived from the number of workers, so that serial and threaded
+    # runs perform exactly the same operations
+    time_block = 4
+
+    def __init__(self, attribute_grids, local_timezone, date_str, lat_lon,
+                 sun_backend='pysolar', dtype=np.float64, horizons=None,
+                 time_step='15min', ephemeris_step='15min', terrain=None):
         '''
         Parameters
         ==========
@@ -19,33 +201,173 @@ class Correction():
             YYYMMDD format
         lat_lon : tuple, length == 2
 
+        sun_backend : str
+            one of sunposition.BACKENDS; 'pysolar' calls pysolar per
+            timestamp, 'noaa' is a single vectorized computation.
+        dtype : str or np.dtype
+            float64 or float32; the precision of the terrain bases and
+            of every correction array returned (see PreparedTerrain).
+        horizons : horizon.Horizons, optional
+            horizon angles for the DEM the attribute grids came from;
+            when given, cells in cast shadow get a correction of 0.
+        time_step : str or pd.Timedelta
+            spacing of the timesteps, aligned to local midnight; at
+            least one minute.
+        ephemeris_step : str or pd.Timedelta
+            spacing of the exact sun positions computed by sun_backend.
+            Sunrise and sunset are solved for between them, and only
+            sunlit timesteps are generated. When time_step is finer,
+            the timesteps' sun positions are interpolated from them
+            (see sunposition.interpolate_sunposition); otherwise they
+            are computed exactly.
+        terrain : PreparedTerrain, optional
+            prepared from attribute_grids with this dtype (and with
+            horizons, which may then be omitted), e.g. one shared by
+            the Corrections of every date of a DEM; built on first use
+            otherwise.
         '''
+        import pandas as pd
+
         self.attribute_grids = attribute_grids
         self.local_timezone = local_timezone
         self.date_str = f'{date_str[:4]}-{date_str[4:6]}-{date_str[6:8]}'
         self.lat, self.lon = lat_lon
+        self.sun_backend = sunposition.get_backend(sun_backend)
+        self.dtype = np.dtype(dtype)
+        self.horizons = horizons
+        self._terrain = terrain
+        self.time_step = pd.Timedelta(time_step)
+        self.ephemeris_step = pd.Timedelta(ephemeris_step)
+        if self.time_step < pd.Timedelta('1min'):
+            raise ValueError(f'time_step {time_step!r} is under one minute')
+        if self.ephemeris_step <= pd.Timedelta(0):
+            raise ValueError(f'ephemeris_step {ephemeris_step!r} is not positive')
         self.sunposition_df = self._init_dataframe()
 
+    @property
+    def attribute_grids(self):
+        return self._attribute_grids
+
+    @attribute_grids.setter
+    def attribute_grids(self, attribute_grids):
+        self._attribute_grids = attribute_grids
+        self._terrain = None
+
+    @property
+    def horizons(self):
+        return self._horizons
+
+    @horizons.setter
+    def horizons(self, horizons):
+        self._horizons = horizons
+        self._terrain = None
+
+    @property
+    def terrain(self):
+        '''
+        PreparedTerrain for self.attribute_grids and self.horizons, as
+        given or built on first use; rebuilt after either changes.
+        '''
+        if self._terrain is None:
+            self._terrain = PreparedTerrain(*self.attribute_grids,
+                                            dtype=self.dtype,
+                                            horizons=self.horizons)
+        return self._terrain
+
+    @property
+    def compact_horizons(self):
+        '''
+        the horizons compressed to the valid cells of self.terrain, or
+        None without horizons.
+        '''
+        return self.terrain.horizons
+
+    def _sun_coefficients(self):
+        '''
+        PreparedTerrain coefficients for every sunlit timestep.
+        '''
+        alts = self.sunposition_df['altitude'].to_numpy()
+        azis = self.sunposition_df['azimuth'].to_numpy()
+        return self.terrain.coefficients(
+            T0=np.deg2rad(alts), P0=np.deg2rad(180 - azis)
+        )
+
+    @instrument.timed('sunposition')
     def _init_dataframe(self):
+        import pandas as pd
+
         df = pd.DataFrame()
+        self._solve_daylight()
         df = self._add_localtime_to_df(df=df)
         df = self._add_utctime_to_df(df=df)
         df = self._add_sunposition_to_df(df=df)
         df = self._drop_nonsunlit_rows(df=df)
         return df
 
+    def _solve_daylight(self):
+        '''
+        Computes the exact ephemeris every self.ephemeris_step over the
+        day, in one call to the backend, and solves it for sunrise and
+        sunset. Sets self.daylight to the day's (sunrise, sunset) local
+        timestamps; a sun that is up at either end of the day (polar
+        day) rises or sets there instead.
+        '''
+        import pandas as pd
+
+        self._day_start = pd.Timestamp(self.date_str, tz=self.local_timezone)
+        n_nodes = int(np.ceil(pd.Timedelta('1D') / self.ephemeris_step)) + 1
+        offsets = np.arange(n_nodes) * self.ephemeris_step.total_seconds()
+
+        altitude, azimuth = self.sun_backend(
+            self._to_utc(offsets), self.lat, self.lon
+        )
+        self._ephemeris = (offsets, altitude, azimuth)
+        self._sunlit = sunposition.sunlit_intervals(
+            offsets, altitude, azimuth, self.lat
+        )
+        self.daylight = [
+            tuple(self._day_start + pd.to_timedelta(self._sunlit[i], unit='s'))
+            for i in range(len(self._sunlit))
+        ]
+
+    def _to_utc(self, offsets):
+        '''
+        naive UTC datetime64 values for offsets (seconds) from local
+        midnight.
+        '''
+        import pandas as pd
+
+        start = self._day_start.tz_convert('UTC').tz_localize(None)
+        return (start + pd.to_timedelta(offsets, unit='s')).to_numpy()
+
     def _add_localtime_to_df(self, df):
         '''
+        timesteps every self.time_step from local midnight, over 24
+        hours, generated only within the sunlit intervals.
         '''
-        df['local_timestamps'] = pd.date_range(
-            start=self.date_str + ' 00:00', 
-            freq='15min', periods=96, tz=self.local_timezone
+        import pandas as pd
+
+        step = self.time_step.total_seconds()
+        n_steps = int(np.ceil(pd.Timedelta('1D') / self.time_step))
+        # widened by a second either side, beyond the tolerance of the
+        # sunrise/sunset solution; instants found to be dark are dropped
+        steps = [
+            np.arange(np.ceil((start - 1) / step),
+                      min(np.floor((end + 1) / step) + 1, n_steps))
+            for start, end in self._sunlit
+        ]
+        offsets = np.concatenate([np.zeros(0)] + steps) * step
+        df['local_timestamps'] = (
+            self._day_start + pd.to_timedelta(offsets, unit='s')
         )
+        self._offsets = offsets
         return df
 
     def _add_utctime_to_df(self, df):
         '''
         '''
+        import pandas as pd
+
         #df['utc_timestamps'] = df['local_timestamps'].tz_convert('UTC')
         df['utc_timestamps'] = pd.to_datetime(
             df['local_timestamps']).dt.tz_convert('UTC')
@@ -54,16 +376,24 @@ class Correction():
     def _add_sunposition_to_df(self, df):
         '''
         '''
-        dts = pd.to_datetime(
-            df['utc_timestamps'], infer_datetime_format=True,
-        )
-        df['altitude'] = [
-            90 - solar.get_altitude(self.lat, self.lon, utc_dt) 
-            for utc_dt in dts
-        ]
-        df['azimuth'] = [
-            solar.get_azimuth(self.lat, self.lon, utc_dt) for utc_dt in dts
-        ]
+        import pandas as pd
+
+        offsets, node_altitude, node_azimuth = self._ephemeris
+        if self.time_step % self.ephemeris_step == pd.Timedelta(0):
+            # every timestep is one of the nodes
+            nodes = np.rint(
+                self._offsets / self.ephemeris_step.total_seconds()
+            ).astype(np.intp)
+            altitude, azimuth = node_altitude[nodes], node_azimuth[nodes]
+        elif self.time_step > self.ephemeris_step:
+            dts = df['utc_timestamps'].dt.tz_localize(None).to_numpy()
+            altitude, azimuth = self.sun_backend(dts, self.lat, self.lon)
+        else:
+            altitude, azimuth = sunposition.interpolate_sunposition(
+                offsets, node_altitude, node_azimuth, self._offsets, self.lat
+            )
+        df['altitude'] = 90 - altitude
+        df['azimuth'] = azimuth
         return df
 
     @staticmethod
@@ -72,45 +402,189 @@ class Correction():
         '''
         return df[df['altitude'] < 90]
 
-    def calc_correction_onetime(self, time):
-        '''
-        
-        '''
+    def _correction_compact(self, time, out=None):
         alt = self.sunposition_df['altitude'].iloc[time]
         azi = self.sunposition_df['azimuth'].iloc[time]
+
+        coeffs = self.terrain.coefficients(
+            T0=np.deg2rad([alt]), P0=np.deg2rad([180 - azi])
+        )
+        out = self.terrain.correction_onetime(coeffs[0], out=out)
+
+        if self.compact_horizons is not None:
+            out[self.compact_horizons.shadow_mask(alt, azi)] = 0
+        return out
+
+    @instrument.timed('correction_onetime')
+    def calc_correction_onetime(self, time, out=None, compact=False):
+        '''
+        Parameters
+        ==========
+        time : int
+            positional index into the sunlit rows of self.sunposition_df
+        out : ndarray, optional
+            buffer with the shape of the attribute grids, into which
+            the correction is written in place (may be a non-contiguous
+            view, e.g. one slice of a preallocated stack).
+        compact : bool
+            return only the valid cells, as a (cells,) array (see
+            PreparedTerrain); out, if given, must then have that shape.
+            Otherwise, invalid cells are set to no_data.
+        '''
+        if compact:
+            return self._correction_compact(time, out=out)
+        values = self._correction_compact(
+            time, out=self.terrain.compact_view(out)
+        )
+        return self.terrain.scatter(values, out=out)
     
-        slope, aspect = self.attribute_grids
+    @instrument.timed('correction_fullday')
+    def calc_correction_fullday(self, workers=None, progress=None,
+                                compact=False):
+        '''
+        here's the ufunc magic: every sunlit timestep in
+        self.sunposition_df is evaluated against the prepared terrain
+        bases as a matrix product, rather than looping over
+        calc_correction_onetime.
 
-        T0 = np.deg2rad(alt)
-        P0 = np.deg2rad(180 - azi)
+        Parameters
+        ==========
+        workers : int, optional
+            the day is split into blocks of self.time_block timesteps,
+            which are written into one preallocated stack. With workers,
+            the blocks are evaluated concurrently on a thread pool of
+            that size (NumPy releases the GIL), with results identical
+            to the serial path.
+        progress : callable, optional
+            called as progress(done, total), in timesteps, as each
+            block completes.
+        compact : bool
+            return a (time, cells) stack of the valid cells only (see
+            PreparedTerrain), rather than scattering each block into
+            full rasters.
 
-        S = np.deg2rad(slope) 
-        A = np.deg2rad(aspect)
+        Returns
+        =======
+        correction stack : ndarray, shape == (time, rows, cols)
+            equal (to within float tolerance) to stacking
+            calc_correction_onetime(i) for each sunlit row i.
+        '''
+        coeffs = self._sun_coefficients()
+        alts = self.sunposition_df['altitude'].to_numpy()
+        azis = self.sunposition_df['azimuth'].to_numpy()
 
-        cosT0 = np.cos(T0)
-        cosS = np.cos(S)
-        sinT0 = np.sin(T0)
-        sinS = np.sin(S)
-        cosP0A = np.cos(P0 - A)
+        n_times = len(coeffs)
+        shape = (self.terrain.n_cells,) if compact else self.terrain.shape
+        stack = np.empty((n_times, *shape), dtype=self.dtype)
 
-        cosT = (cosT0*cosS) + (sinT0*sinS*cosP0A)
+        def fill(block):
+            if compact:
+                values = stack[block]
+            else:
+                values = self.terrain.compact_view(stack[block])
+            values = self.terrain.correction(coeffs[block], out=values)
+            if self.compact_horizons is not None:
+                shadow = self.compact_horizons.shadow_mask(alts[block],
+                                                           azis[block])
+                values[shadow] = 0
+            if not compact:
+                self.terrain.scatter(values, out=stack[block])
+            return block
 
-        return cosT/cosT0
-    
-    def calc_correction_fullday(self):
+        blocks = [
+            slice(t, t + self.time_block)
+            for t in range(0, n_times, self.time_block)
+        ]
+        if workers:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for block in pool.map(fill, blocks):
+                    if progress is not None:
+                        progress(min(block.stop, n_times), n_times)
+        else:
+            for block in blocks:
+                fill(block)
+                if progress is not None:
+                    progress(min(block.stop, n_times), n_times)
+
+        return stack
+
+    @instrument.timed('daily_aggregates')
+    def calc_daily_aggregates(self, stats=AGGREGATES, stack=None,
+                              compact=False):
         '''
-        here's the ufunc magic
+        Reduces the day's corrections over time, one timestep at a time,
+        on the valid cells only, so memory is O(cells) however many
+        timesteps there are.
+
+        Parameters
+        ==========
+        stats : iterable of str
+            any of AGGREGATES. The weighted statistics weight each
+            timestep by cos(zenith), i.e. by insolation on a flat
+            surface, so weighted_sum is the day's summed cosT and
+            weighted_mean the insolation-weighted mean correction.
+        stack : ndarray, optional
+            the (time, rows, cols) or compact (time, cells) stack from
+            calc_correction_fullday, if already computed; it is reduced
+            instead of recomputing each timestep.
+        compact : bool
+            return (cells,) arrays of the valid cells, rather than
+            rasters with no_data in the invalid cells.
+
+        Returns
+        =======
+        dict of str to ndarray, shape == (rows, cols)
+            with no sunlit timesteps (polar night), sum and
+            weighted_sum are 0 and the other statistics nan.
         '''
-        alts = self.sunposition_df['altitude']
-        azis = self.sunposition_df['azimuth']
+        stats = tuple(stats)
+        unknown = set(stats) - set(AGGREGATES)
+        if unknown:
+            raise ValueError(
+                f'unknown aggregates {sorted(unknown)}, '
+                f'expected any of {AGGREGATES}'
+            )
 
-        slope, aspect = self.attribute_grids
+        n_times = self.sunposition_df.shape[0]
+        weights = np.cos(np.deg2rad(self.sunposition_df['altitude'].to_numpy()))
 
-        T0s = np.deg2rad(alts)
-        P0s = np.deg2rad(180 - azis)
+        shape = self.terrain.n_cells
+        total = np.zeros(shape, dtype=self.dtype)
+        weighted = np.zeros(shape, dtype=self.dtype)
+        maximum = np.full(shape, -np.inf, dtype=self.dtype)
+        buffer = np.empty(shape, dtype=self.dtype)
 
-        Ss = np.deg2rad(slope) # these need to be a full stack
-        As = np.deg2rad(aspect) # " '  '" " "
+        for i in range(n_times):
+            if stack is None:
+                self._correction_compact(i, out=buffer)
+            elif stack.ndim == 2:
+                buffer[...] = stack[i]
+            else:
+                buffer[...] = self.terrain.compress(stack[i])
+            if 'sum' in stats or 'mean' in stats:
+                np.add(total, buffer, out=total)
+            if 'max' in stats:
+                np.maximum(maximum, buffer, out=maximum)
+            if 'weighted_sum' in stats or 'weighted_mean' in stats:
+                np.multiply(buffer, weights[i], out=buffer)
+                np.add(weighted, buffer, out=weighted)
 
-        pass
-    
\ No newline at end of file
+        if n_times:
+            results = {
+                'sum': total,
+                'mean': total / n_times,
+                'max': maximum,
+                'weighted_sum': weighted,
+                'weighted_mean': weighted / weights.sum(),
+            }
+        else:
+            results = {
+                'sum': total,
+                'mean': np.full(shape, np.nan, dtype=self.dtype),
+                'max': np.full(shape, np.nan, dtype=self.dtype),
+                'weighted_sum': weighted,
+                'weighted_mean': np.full(shape, np.nan, dtype=self.dtype),
+            }
+        if compact:
+            return {stat: results[stat] for stat in stats}
+        return {stat: self.terrain.scatter(results[stat]) for stat in stats}
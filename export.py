@@ -0,0 +1,299 @@
+import zipfile
+
+import numpy as np
+
+class _ChunkBuffer():
+    '''
+    A write-only, unseekable file object. zipfile writes members to it
+    with data descriptors, and the bytes written so far are handed out
+    (and released) by take().
+    '''
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+# bytes of a member written between yields, so that the bytes held for
+# the next chunk stay well below the size of a large member
+CHUNK_BYTES = 1 << 24
+
+def _write_npy(f, array, buffer):
+    '''
+    Writes array to f in the .npy format, as np.lib.format.write_array
+    does, but CHUNK_BYTES at a time along its first axis, yielding the
+    bytes taken from buffer after each.
+    '''
+    if array.ndim == 0 or array.dtype.hasobject:
+        np.lib.format.write_array(f, array)
+        yield buffer.take()
+        return
+    header = np.lib.format.header_data_from_array_1_0(array)
+    np.lib.format.write_array_header_1_0(f, header)
+    # a Fortran-ordered array is written as its C-ordered transpose
+    flat = array.T if header['fortran_order'] else array
+    row_bytes = max(flat[:1].nbytes, 1)
+    step = max(CHUNK_BYTES // row_bytes, 1)
+    for start in range(0, len(flat), step):
+        piece = np.ascontiguousarray(flat[start:start + step])
+        f.write(piece.reshape(-1).view(np.uint8))
+        yield buffer.take()
+
+def iter_npz_chunks(members, compress=False):
+    '''
+    Writes an .npz archive incrementally, yielding its bytes a slice of
+    a member at a time (see CHUNK_BYTES).
+
+    Parameters
+    ==========
+    members : iterable of (str, ndarray)
+        may be a generator, so that each array is computed only when
+        the previous one has been sent.
+    compress : bool
+        deflate the members, as np.savez_compressed does
+    '''
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, mode='w', compression=compression,
+                         allowZip64=True) as zf:
+        for name, array in members:
+            with zf.open(f'{name}.npy', mode='w', force_zip64=True) as f:
+                yield from _write_npy(f, np.asanyarray(array), buffer)
+            yield buffer.take()
+    yield buffer.take()
+
+def quantize(array, dtype=np.int16, no_data=-9999):
+    '''
+    Linearly maps a float array onto the integers of dtype, with its
+    own scale and offset, so that array ~= q*scale + offset. The
+    largest integer of dtype is reserved for cells that are nodata or
+    not finite; every other value is reproduced to within scale/2,
+    where scale is the array's (max - min) / 65534 for 16-bit types.
+
+    Returns
+    =======
+    q : ndarray of dtype
+    quantization : ndarray, [scale, offset, fill]
+        fill is the value that dequantize restores for the reserved
+        integer: no_data, or nan if None.
+    '''
+    array = np.asarray(array)
+    info = np.iinfo(dtype)
+    invalid = ~np.isfinite(array)
+    if no_data is not None:
+        invalid |= array == no_data
+    valid = array[~invalid]
+
+    lo, hi = (valid.min(), valid.max()) if valid.size else (0., 0.)
+    scale = (hi - lo) / (int(info.max) - 1 - int(info.min)) or 1.
+    offset = lo - int(info.min)*scale
+
+    q = np.rint((array - offset) / scale)
+    q[invalid] = info.max
+    fill = np.nan if no_data is None else no_data
+    return q.astype(dtype), np.array([scale, offset, fill])
+
+def dequantize(q, quantization, dtype=np.float64):
+    '''
+    inverse of quantize.
+    '''
+    scale, offset, fill = quantization
+    array = q.astype(dtype)*dtype(scale) + dtype(offset)
+    array[q == np.iinfo(q.dtype).max] = fill
+    return array
+
+# which members of an export each QUANTIZE option stores as integers
+QUANTIZE = {
+    'none': {},
+    'stack': {'correction': np.int16, 'daily': np.int16},
+    'all': {'correction': np.int16, 'daily': np.int16,
+            'slope': np.uint16, 'aspect': np.uint16},
+}
+
+def _quantized_members(members, option):
+    dtypes = QUANTIZE[option]
+    for name, array in members:
+        dtype = dtypes.get(name.split('_')[0])
+        if dtype is None:
+            yield name, array
+        else:
+            q, quantization = quantize(array, dtype)
+            yield name, q
+            yield f'{name}_quantization', quantization
+
+def read_member(npz, name, no_data=-9999):
+    '''
+    Reads member name from an archive opened with np.load, dequantizing
+    it if it was written quantized, and scattering it back into a full
+    raster, with no_data in the invalid cells, if it was written
+    compact.
+    '''
+    if f'{name}_quantization' in npz.files:
+        array = dequantize(npz[name], npz[f'{name}_quantization'])
+    else:
+        array = npz[name]
+    if 'valid_index' in npz.files and name.startswith(COMPACT_MEMBERS):
+        shape = tuple(npz['grid_shape'])
+        raster = np.full(int(np.prod(shape)), no_data, dtype=array.dtype)
+        raster[npz['valid_index']] = array
+        array = raster.reshape(shape)
+    return array
+
+MODES = ('stack', 'aggregates', 'both')
+
+# members holding only the valid cells in a compact export
+COMPACT_MEMBERS = ('correction_', 'daily_')
+
+def _correction_members(elevation, slope, aspect, correct, stack, mode,
+                        compact):
+    yield 'elevation', elevation
+    yield 'slope', slope
+    yield 'aspect', aspect
+    yield 'sunposition', correct.sunposition_df.to_numpy()
+    if compact:
+        yield 'grid_shape', np.array(correct.terrain.shape)
+        yield 'valid_index', correct.terrain.index
+    if mode in ('aggregates', 'both'):
+        aggregates = correct.calc_daily_aggregates(stack=stack,
+                                                   compact=compact)
+        for stat, array in aggregates.items():
+            yield f'daily_{stat}', array
+    if mode in ('stack', 'both'):
+        for i in range(correct.sunposition_df.shape[0]):
+            if stack is None:
+                array = correct.calc_correction_onetime(i, compact=compact)
+            elif compact and stack.ndim == 3:
+                array = correct.terrain.compress(stack[i])
+            else:
+                array = stack[i]
+            yield f'correction_{i:03d}', array
+
+def iter_export_chunks(elevation, slope, aspect, correct, stack=None,
+                       mode='stack', quantize='none', compact=False):
+    '''
+    Yields the export archive for a DEM in chunks, computing each
+    timestep's correction only as it is written, so that at most one
+    timestep is held in memory. Each timestep is its own member,
+    correction_000, correction_001, ..., readable individually with
+    np.load; load_correction_stack reassembles the full stack.
+
+    If the (time, rows, cols) stack from correct.calc_correction_fullday
+    has already been computed, pass it as stack to reuse it.
+
+    mode is one of MODES: 'aggregates' replaces the per-timestep members
+    with the daily_sum, daily_mean, daily_max, daily_weighted_sum and
+    daily_weighted_mean rasters from correct.calc_daily_aggregates,
+    shrinking the archive by a factor of the number of timesteps;
+    'both' writes the aggregates followed by the per-timestep members.
+
+    quantize is one of QUANTIZE: 'stack' stores the correction and
+    daily rasters as int16, and 'all' also slope and aspect as uint16,
+    each with a <name>_quantization member holding its scale and
+    offset (see quantize), in a deflated archive. read_member and
+    load_correction_stack dequantize them on read.
+
+    With compact, the correction and daily members hold only the valid
+    cells of correct.terrain, as 1D arrays, so the archive scales with
+    the valid area of the DEM rather than its bounding box. The
+    valid_index member holds their flat indices into rasters of shape
+    grid_shape; read_member and load_correction_stack scatter them back.
+    '''
+    if mode not in MODES:
+        raise ValueError(
+            f'unknown export mode {mode!r}, expected one of {MODES}'
+        )
+    if quantize not in QUANTIZE:
+        raise ValueError(
+            f'unknown quantize option {quantize!r}, '
+            f'expected one of {tuple(QUANTIZE)}'
+        )
+    members = _correction_members(elevation, slope, aspect, correct, stack,
+                                  mode, compact)
+    if quantize == 'none':
+        return iter_npz_chunks(members)
+    return iter_npz_chunks(_quantized_members(members, quantize),
+                           compress=True)
+
+def load_correction_stack(file):
+    '''
+    Returns the (rows, cols, time) correction stack from an archive
+    written by iter_export_chunks, dequantized if it was quantized and
+    scattered back into full rasters if it was compact.
+    '''
+    with np.load(file, allow_pickle=True) as npz:
+        # ordered by timestep number, which outgrows the zero padding
+        # of the names from 1000 timesteps on
+        names = sorted(
+            (k for k in npz.files if k.startswith('correction_')
+             and not k.endswith('_quantization')),
+            key=lambda k: int(k.split('_')[1])
+        )
+        if not names:
+            # a day without sun (polar night) has no timesteps
+            slope = read_member(npz, 'slope')
+            return np.empty((*slope.shape, 0), dtype=slope.dtype)
+        first = read_member(npz, names[0])
+        stack = np.empty((*first.shape, len(names)), dtype=first.dtype)
+        stack[..., 0] = first
+        for i, name in enumerate(names[1:], start=1):
+            stack[..., i] = read_member(npz, name)
+    return stack
+
+def make_export_handler(load_terrain):
+    '''
+    Returns a tornado RequestHandler that streams the export archive for
+    the DEM named in the ?dem= query argument as it is computed, so the
+    first bytes reach the client before the rest of the day is done.
+    Optional ?mode= and ?quantize= arguments select one of MODES and
+    one of QUANTIZE, and ?compact=1 writes the compact form.
+
+    Parameters
+    ==========
+    load_terrain : callable
+        load_terrain(dem) -> (elevation, slope, aspect, correct)
+    '''
+    from tornado.ioloop import IOLoop
+    from tornado.web import HTTPError, RequestHandler
+
+    class ExportHandler(RequestHandler):
+
+        async def get(self):
+            dem = self.get_argument('dem')
+            mode = self.get_argument('mode', 'stack')
+            quantize = self.get_argument('quantize', 'none')
+            if mode not in MODES:
+                raise HTTPError(400, f'unknown export mode {mode!r}')
+            if quantize not in QUANTIZE:
+                raise HTTPError(400, f'unknown quantize option {quantize!r}')
+            compact = self.get_argument('compact', '0') not in ('0', '')
+
+            # loading the terrain may compute it, which must not block
+            # the IOLoop (and so every other session) any more than
+            # computing the chunks may
+            loop = IOLoop.current()
+            terrain = await loop.run_in_executor(None, load_terrain, dem)
+            chunks = iter_export_chunks(*terrain, mode=mode,
+                                        quantize=quantize, compact=compact)
+
+            name = f'{dem[:-4]}_correction.npz'
+            self.set_header('Content-Type', 'application/zip')
+            self.set_header('Content-Disposition',
+                            f'attachment; filename="{name}"')
+
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                self.write(chunk)
+                await self.flush()
+
+    return ExportHandler
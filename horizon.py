@@ -0,0 +1,205 @@
+import copy
+
+import numpy as np
+
+import instrument
+
+def _orient(grid, azimuth):
+    '''
+    Flips and/or transposes grid so that looking towards azimuth
+    (degrees clockwise from north, row 0 being the southern edge, as
+    in Attributes' aspect and the plots' origin='lower')
+    becomes looking along increasing column index, with at most one
+    row of drift per column. Returns the oriented grid, the drift per
+    column, and a function that maps an oriented result back.
+    '''
+    drow, dcol = np.cos(np.deg2rad(azimuth)), np.sin(np.deg2rad(azimuth))
+
+    transpose = abs(drow) > abs(dcol)
+    if transpose:
+        grid, drow, dcol = grid.T, dcol, drow
+    flip = dcol < 0
+    if flip:
+        grid = grid[:, ::-1]
+
+    def restore(result):
+        if flip:
+            result = result[:, ::-1]
+        if transpose:
+            result = result.T
+        return result
+
+    return grid, drow/abs(dcol), restore
+
+def _scan_lines(z, dist):
+    '''
+    Linear-time horizon search (Dozier, Bruno & Downey 1981), run on
+    every line at once. z has one line per row, ordered in the look
+    direction, with -inf for cells that are nodata or off the grid.
+    dist(i, j) is the distance between positions i and j, and must be
+    proportional to j - i.
+
+    The horizon of point i is found by walking the chain of horizons
+    already found for the points beyond it: starting from j = i + 1,
+    step to h[j] while it is steeper from i than j is. The chain is the
+    upper convex hull of the profile, so the total work is linear.
+
+    Returns the tangent of the horizon angle for every point.
+    '''
+    n_lines, n = z.shape
+    lines = np.arange(n_lines)
+    h = np.empty((n_lines, n), dtype=np.intp)
+    h[:, n-1] = n-1
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i in range(n-2, -1, -1):
+            zi = z[:, i]
+            j = np.full(n_lines, i+1)
+            s_ij = (z[:, i+1] - zi) / dist(i, i+1)
+            while True:
+                k = h[lines, j]
+                s_ik = (z[lines, k] - zi) / dist(i, k)
+                move = (k != j) & (s_ik > s_ij)
+                if not move.any():
+                    break
+                j = np.where(move, k, j)
+                s_ij = np.where(move, s_ik, s_ij)
+            # invalid cells pass the search straight through to the
+            # next valid cell, so that a gap of any width is skipped in
+            # one step
+            h[:, i] = np.where(
+                np.isfinite(zi), j,
+                np.where(np.isfinite(z[:, i+1]), i+1, h[:, i+1])
+            )
+
+        positions = np.arange(n)
+        z_h = z[lines[:, np.newaxis], h]
+        tan_h = (z_h - z) / dist(positions, h)
+    tan_h[(h == positions) | ~np.isfinite(z)] = -np.inf
+    return tan_h
+
+def horizon_angles(elevation, cell_size, azimuth, no_data=-9999):
+    '''
+    Horizon elevation angle (radians) of every cell, looking towards
+    azimuth (degrees clockwise from north). Cells with no horizon
+    above them, and nodata cells, get -pi/2.
+
+    The grid is cut into parallel lines of cells along the azimuth,
+    each line stepping one column (or row) at a time and drifting by
+    the rounded tangent of the direction, so that every cell belongs to
+    exactly one line. All lines are then scanned together.
+    '''
+    z = np.where(elevation == no_data, -np.inf, elevation).astype(np.float64)
+    z, drift, restore = _orient(z, azimuth)
+    rows, cols = z.shape
+
+    offsets = np.rint(np.arange(cols) * drift).astype(np.intp)
+    starts = np.arange(-offsets.max(), rows - offsets.min())
+    line_rows = starts[:, np.newaxis] + offsets[np.newaxis, :]
+    on_grid = (line_rows >= 0) & (line_rows < rows)
+    line_cols = np.broadcast_to(np.arange(cols), line_rows.shape)
+
+    lines = np.full(line_rows.shape, -np.inf)
+    lines[on_grid] = z[line_rows[on_grid], line_cols[on_grid]]
+
+    # distances are measured along the ideal straight line, which keeps
+    # each profile one-dimensional (as the scan requires); the cells
+    # themselves are never more than half a cell off that line
+    step = cell_size * np.hypot(1, drift)
+    def dist(i, j):
+        return step * (j - i)
+
+    tan_h = _scan_lines(lines, dist)
+
+    angles = np.empty_like(z)
+    angles[line_rows[on_grid], line_cols[on_grid]] = np.arctan(tan_h[on_grid])
+    return np.ascontiguousarray(restore(angles))
+
+class Horizons():
+    '''
+    Horizon angles of every cell of a DEM, for n_bins azimuths evenly
+    spaced clockwise from north, and the cast-shadow masks derived from
+    them. Computing these is the expensive part; they depend only on
+    the DEM and cell size, so one instance can be cached per DEM and
+    shared by every Correction made from it.
+    '''
+    def __init__(self, elevation, cell_size, n_bins=16, no_data=-9999,
+                 out=None):
+        '''
+        Parameters
+        ==========
+        elevation : 2D array
+            DEM, with row 0 as its southern edge
+        cell_size : float
+            side length of one cell, in the DEM's vertical units
+        n_bins : int
+            number of azimuth directions
+        out : ndarray, shape == (n_bins, rows, cols), optional
+            array the angles are written into, one azimuth at a time,
+            e.g. a memory-mapped .npy for a DEM whose angles would not
+            fit in memory; it becomes self.angles. Each azimuth is
+            still computed in memory, over the whole DEM.
+        '''
+        self.n_bins = n_bins
+        self.azimuths = np.arange(n_bins) * 360 / n_bins
+        elevation = np.asarray(elevation)
+        with instrument.stage('horizons') as stage:
+            if out is None:
+                self.angles = np.stack([
+                    horizon_angles(elevation, cell_size, azimuth, no_data)
+                    for azimuth in self.azimuths
+                ])
+            else:
+                for i, azimuth in enumerate(self.azimuths):
+                    out[i] = horizon_angles(elevation, cell_size, azimuth,
+                                            no_data)
+                self.angles = out
+            stage.nbytes = self.angles.nbytes
+
+    def window(self, region):
+        '''
+        Returns a copy holding only the cells in region, a (rows, cols)
+        pair of slices, e.g. one tile of the DEM. Its angles are a view
+        of self.angles.
+        '''
+        window = copy.copy(self)
+        window.angles = self.angles[(slice(None), *region)]
+        return window
+
+    def compress(self, valid=None):
+        '''
+        Returns a copy holding only the cells where valid (a boolean
+        rows x cols mask; None for all of them) is True, in row-major
+        order, so that its shadow masks have a single cells axis in
+        place of rows and cols. See correction.PreparedTerrain.
+        '''
+        compact = copy.copy(self)
+        if valid is None:
+            compact.angles = self.angles.reshape(self.n_bins, -1)
+        else:
+            compact.angles = self.angles[:, valid]
+        return compact
+
+    def bin_index(self, azimuth):
+        '''
+        index of the azimuth bin nearest to azimuth (degrees clockwise
+        from north); accepts scalars or arrays.
+        '''
+        step = 360 / self.n_bins
+        return np.rint(np.mod(azimuth, 360) / step).astype(np.intp) % self.n_bins
+
+    def shadow_mask(self, zenith, azimuth):
+        '''
+        Boolean mask of cells whose horizon towards the sun is higher
+        than the sun. zenith and azimuth are in degrees, as in
+        Correction.sunposition_df; given arrays of length time, the
+        mask has shape (time, rows, cols), or (time, cells) once
+        compressed.
+        '''
+        sun_elevation = np.deg2rad(90 - np.asarray(zenith))
+        angles = self.angles[self.bin_index(azimuth)]
+        if sun_elevation.ndim:
+            sun_elevation = sun_elevation.reshape(
+                -1, *(1,)*(self.angles.ndim - 1)
+            )
+        return angles > sun_elevation
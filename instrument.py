@@ -0,0 +1,106 @@
+'''
+Lightweight, process-wide instrumentation of the pipeline's stages.
+
+Stages are functions decorated with @timed, or blocks wrapped in
+`with stage(name)`. While enabled, every run of a stage adds to its
+call count, wall time and bytes, the latter being the memory held by
+the arrays it returns (as estimated by cache.nbytes) or, for a block,
+whatever it adds to the stage's nbytes. Time spent in a stage nested
+in another counts towards both. While disabled, which is the default,
+a stage costs one flag check per call.
+'''
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from cache import nbytes
+
+_enabled = False
+_stats = {}
+_lock = threading.Lock()
+
+def enable(flag=True):
+    global _enabled
+    _enabled = bool(flag)
+
+def enabled():
+    return _enabled
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+def record(name, seconds, nbytes=0):
+    '''
+    adds one call of stage name, taking seconds and returning nbytes.
+    '''
+    with _lock:
+        stats = _stats.setdefault(name, {'calls': 0, 'seconds': 0.,
+                                         'bytes': 0})
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['bytes'] += nbytes
+
+def snapshot():
+    '''
+    returns {stage: {'calls', 'seconds', 'bytes'}} for every stage run
+    since the last reset, sorted by total time, slowest first.
+    '''
+    with _lock:
+        stats = {name: dict(s) for name, s in _stats.items()}
+    return dict(sorted(stats.items(), key=lambda s: -s[1]['seconds']))
+
+def to_json(**kwargs):
+    return json.dumps(snapshot(), **kwargs)
+
+class _Stage():
+    nbytes = 0
+
+@contextmanager
+def stage(name):
+    '''
+    Records the enclosed block as one call of stage name. The context
+    value has an nbytes attribute that the block may add to.
+    '''
+    block = _Stage()
+    if not _enabled:
+        yield block
+        return
+    start = time.perf_counter()
+    try:
+        yield block
+    finally:
+        record(name, time.perf_counter() - start, block.nbytes)
+
+def timed(name):
+    '''
+    decorator recording each call of the function as one call of stage
+    name, with the bytes of the arrays it returns.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            record(name, time.perf_counter() - start, nbytes(result))
+            return result
+        return wrapper
+    return decorator
+
+def make_diagnostics_handler():
+    '''
+    Returns a tornado RequestHandler serving snapshot() as JSON.
+    '''
+    from tornado.web import RequestHandler
+
+    class DiagnosticsHandler(RequestHandler):
+
+        def get(self):
+            self.set_header('Content-Type', 'application/json')
+            self.write(to_json())
+
+    return DiagnosticsHandler
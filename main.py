@@ -1,11 +1,16 @@
 import os
+import threading
+from functools import partial
 from tempfile import TemporaryFile
+from urllib.parse import urlencode
 
 import param
 import panel as pn
 import numpy as np
 import matplotlib.pyplot as plt
 from bokeh.settings import settings
+from bokeh.plotting import figure
+from bokeh.models import ColumnDataSource
 
 from templates.template import template
 from static.css import css
@@ -15,20 +20,24 @@ from static.extras import extras
 from static.returns import returns
 from static.js import js
 from attributes import Attributes
-from correction import Correction
+from correction import Correction, PreparedTerrain
+from horizon import Horizons
+from pyramid import Pyramid
+from cache import shared_cache, content_hash
+import sharedmem
+import instrument
+from export import MODES, QUANTIZE, iter_export_chunks, make_export_handler
 import config as c
 
+instrument.enable(c.INSTRUMENT)
+
 settings.resources = 'cdn'
 pn.config.raw_css = [css,]
 
 name = 'ufunc-correct'
-tmpl = pn.Template(template)
-tmpl.add_variable('app_title', name)
-tmpl.add_variable('description', description)
-tmpl.add_variable('blockquote', blockquote)
-tmpl.add_variable('extras', extras)
-tmpl.add_variable('returns', returns)
-tmpl.add_variable('js', js)
+
+# set when the app is run with `python main.py`, which serves /export
+STREAM_EXPORT = False
 
 class Interact(param.Parameterized):
     '''
@@ -36,13 +45,32 @@ class Interact(param.Parameterized):
     '''
     def __init__(self):
         super(Interact, self).__init__()
-        self.datapath = name + '/data'
+        self.datapath = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), 'data'
+        )
         self.filelist = os.listdir(self.datapath)
         self.filelist.sort()
+        self.cache = shared_cache(max_bytes=c.CACHE_BYTES)
+        self._init_correction_plot()
+        self.progress = pn.indicators.Progress(
+                name='Precomputing day', value=0, max=1, width=307
+        )
+        self.slope = self.aspect = self.correct = None
+        self.full_stack = None
+        self._precompute_id = 0
+        self._doc = None
     
     # TODO: improve default setting
     DEM = param.Selector(default='20190623_NNR300S20.npy')
     time = param.Integer(0, bounds=(0,100))
+    full_resolution = param.Boolean(default=False)
+    export_mode = param.ObjectSelector(default='stack', objects=list(MODES))
+    export_quantize = param.ObjectSelector(default='none',
+                                           objects=list(QUANTIZE))
+    export_compact = param.Boolean(default=False)
+    # bumped when a DEM's terrain arrives from the worker thread, which
+    # redraws everything that shows it
+    terrain_ready = param.Integer(default=0, precedence=-1)
 
     @staticmethod
     def _format_imshow(fig, ax, title, 
@@ -63,6 +91,22 @@ class Interact(param.Parameterized):
         ax.set_facecolor(bgc)
         fig.patch.set_facecolor(bgc)
 
+    @staticmethod
+    def _format_bokeh(fig, bgc='#292929', axc='#eee', lblc='#fff'):
+        fig.xaxis.axis_label = 'Easting'
+        fig.yaxis.axis_label = 'Northing'
+        fig.title.text_color = axc
+        fig.background_fill_color = bgc
+        fig.border_fill_color = bgc
+        fig.outline_line_color = axc
+        fig.grid.visible = False
+        for axis in (fig.xaxis, fig.yaxis):
+            axis.axis_label_text_color = lblc
+            axis.major_label_text_color = lblc
+            axis.axis_line_color = axc
+            axis.major_tick_line_color = axc
+            axis.minor_tick_line_color = axc
+
     @staticmethod
     def _format_polar(fig, ax, bgc='#292929', axc='#eee', lblc='#fff'):
         tks = [np.deg2rad(a) for a in np.linspace(0,360,8,endpoint=False)]
@@ -100,126 +144,440 @@ class Interact(param.Parameterized):
 
         return date + addendum
 
+    @staticmethod
+    def _mask_no_data(array, no_data=-9999):
+        '''Returns array with no_data cells as nan, which plots leave
+        blank rather than stretching their colormaps down to no_data.
+        '''
+        return np.where(array == no_data, np.nan, array)
+
     def _imshow(self, array, cmap, opt):
         '''Generalized method for calling plt.imshow()
         '''
-        fig, ax = plt.subplots(1)
-        ax.imshow(array, origin='lower', cmap=cmap, )
-        title = self._set_title(fn=self.DEM, opt=opt)
-        self._format_imshow(fig=fig, ax=ax, title=title)
-        plt.close('all')
+        with instrument.stage('render'):
+            fig, ax = plt.subplots(1)
+            # previews are drawn over the full-resolution extent, so
+            # that the axes read the same at every level
+            rows, cols = self.elevation_array.shape
+            ax.imshow(self._mask_no_data(array), origin='lower', cmap=cmap,
+                      extent=(0, cols, 0, rows))
+            title = self._set_title(fn=self.DEM, opt=opt)
+            self._format_imshow(fig=fig, ax=ax, title=title)
+            plt.close('all')
         return fig
 
-    def _looped_correction(self):
+    def _init_correction_plot(self):
+        '''Builds the correction figure once. Its colormap and axes are
+        styled here, and self.output only replaces the image data in
+        self.correction_source on each time change.
         '''
-        '''
-        for i in range(self.correct.sunposition_df.shape[0]):
-            if i == 0:
-                correct_stack = self.correct.calc_correction_onetime(i)
-            else:
-                correct_stack = np.dstack(
-                    (correct_stack, self.correct.calc_correction_onetime(i))
-                )
-        return correct_stack
-    
-    def _ufunc_correction(self):
-        '''
-        '''
-        correct_stack = self.correct.calc_correction_fullday()
-
-        return correct_stack
+        self.correction_source = ColumnDataSource(
+                data={'image': [], 'dw': [], 'dh': []}
+        )
+        fig = figure(width=640, height=480, match_aspect=True,
+                     toolbar_location=None)
+        fig.image(image='image', x=0, y=0, dw='dw', dh='dh',
+                  palette='Magma256', source=self.correction_source)
+        self._format_bokeh(fig)
+        self.correction_fig = fig
+        self.correction_pane = pn.pane.Bokeh(fig)
 
-    @param.depends('DEM')
+    @param.depends('DEM', 'full_resolution')
     def input(self):
         '''Assigns the self.filename and self.elevation_array
-        instance variables. Returns as plot of self.elevation_array.
+        instance variables, and self.view_array, the level of the DEM's
+        preview pyramid that interactive views are computed from.
+        Returns as plot of self.view_array.
         '''
         self.param.DEM.default = self.filelist[0]
         self.param.DEM.objects = self.filelist
-        self.elevation_array = np.load(f'{self.datapath}/{self.DEM}')
+        self.elevation_array, self.dem_hash = self._load_dem(self.DEM)
+        self.level = self._view_level()
+        self.view_array = (self.elevation_array if self.level == 0
+                           else self._pyramid().levels[self.level])
+        self._start_precompute()
         
-        return self._imshow(array=self.elevation_array, cmap='viridis', 
+        return self._imshow(array=self.view_array, cmap='viridis', 
                             opt='elevation')
 
-    @param.depends('time')
-    def output(self):
-        '''Instantiates the Attributes and Correction classes,
-        assigns associated instance variables, and returns a plot
-        of the terrain correction array.
+    def _pyramid(self):
+        '''Returns the selected DEM's preview pyramid from the shared
+        cache, building it on a miss.
         '''
-        self.attributes = Attributes(
-                self.elevation_array,
-                resolution=self.elevation_array.shape[0],
+        return self.cache.get_or_compute(
+                ('pyramid', self.dem_hash, c.PREVIEW_SIZE),
+                lambda: Pyramid(self.elevation_array, min_size=c.PREVIEW_SIZE)
+        )
+
+    def _view_level(self):
+        '''The pyramid level for interactive views: the coarsest one
+        that still fills PREVIEW_SIZE pixels, or the DEM itself with
+        full_resolution on (or PREVIEW_SIZE = 0).
+        '''
+        if self.full_resolution or not c.PREVIEW_SIZE:
+            return 0
+        return self._pyramid().level_for(c.PREVIEW_SIZE)
+
+    def _load_dem(self, dem):
+        '''Returns the memory-mapped DEM and its content hash, from the
+        shared cache while the file is unchanged. Being memory-mapped,
+        the DEM's pages are already shared by every process on the node.
+        '''
+        path = f'{self.datapath}/{dem}'
+
+        def load():
+            with instrument.stage('load_dem') as stage:
+                elevation_array = np.load(path, mmap_mode='r')
+                dem_hash = content_hash(elevation_array)
+                stage.nbytes = elevation_array.nbytes
+            return elevation_array, dem_hash
+
+        return self.cache.get_or_compute(
+                ('dem', path, os.path.getmtime(path)), load
+        )
+
+    def _terrain_key(self, dem_hash, dem, level=0):
+        '''Cache key for the terrain grids and sun table: the DEM's
+        content hash and pyramid level, plus every configuration value
+        they depend on.
+        '''
+        return (dem_hash, level, dem[:8], c.PROJECTION, c.SIDE_LEN,
+                tuple(c.LAT_LON), c.TIMEZONE, c.SUN_BACKEND, c.TIME_STEP,
+                c.EPHEMERIS_STEP, c.ATTRIBUTE_BACKEND, c.DTYPE,
+                c.HORIZON_BINS)
+
+    @staticmethod
+    def _shared(key, compute):
+        '''With SHARED_MEMORY on, returns the array for key from a
+        shared memory segment named after it (key starts with the DEM's
+        content hash), so that every server process on the node attaches
+        to a single copy; the first process to need it computes and
+        publishes it. Otherwise, just returns compute(). A process
+        keeps the segment open only while the array is referenced, by
+        the cache or by a session, and the publishing process removes
+        it once it lets go (see sharedmem).
+        '''
+        if not c.SHARED_MEMORY:
+            return compute()
+        return sharedmem.get_or_publish(sharedmem.segment_name(key), compute)
+
+    def _calc_terrain(self, elevation_array, dem, horizons, key):
+        '''Instantiates the Attributes and Correction classes for a
+        DEM, returning slope, aspect, and the Correction.
+        '''
+        attributes = Attributes(
+                elevation_array,
+                resolution=elevation_array.shape[0],
                 projection=c.PROJECTION,
-                side_len=c.SIDE_LEN
+                side_len=c.SIDE_LEN,
+                backend=c.ATTRIBUTE_BACKEND,
+                dtype=c.DTYPE
+        )
+        slope, aspect = self._shared(key + ('attributes',),
+                lambda: np.stack(attributes.calc_attributes())
         )
-        self.slope, self.aspect = self.attributes.calc_attributes()
 
-        self.correct = Correction(
-                attribute_grids=(self.slope, self.aspect),
+        # the bases and compact horizons are built now rather than on
+        # first use, so that the cache counts them in the entry's size
+        terrain = PreparedTerrain(slope, aspect, dtype=c.DTYPE,
+                                  horizons=horizons)
+        correct = Correction(
+                attribute_grids=(slope, aspect),
                 local_timezone=c.TIMEZONE,
-                date_str=self.DEM[:8],
-                lat_lon=c.LAT_LON
+                date_str=dem[:8],
+                lat_lon=c.LAT_LON,
+                sun_backend=c.SUN_BACKEND,
+                dtype=c.DTYPE,
+                horizons=horizons,
+                time_step=c.TIME_STEP,
+                ephemeris_step=c.EPHEMERIS_STEP,
+                terrain=terrain
         )
-        self.param.time.bounds = (0,self.correct.sunposition_df.shape[0]-1)
-        print(self.param.time.bounds)
-        self.correct_array = self.correct.calc_correction_onetime(self.time)
+        return slope, aspect, correct
 
-        return self._imshow(array=self.correct_array, cmap='magma', 
-                            opt='correction')
+    def _get_terrain(self, elevation_array, dem_hash, dem, level=0):
+        '''Returns slope, aspect and the Correction for a DEM, or for
+        level of its preview pyramid (given as elevation_array), from
+        cache, computing them on a miss. Horizons are cached separately,
+        since they depend only on the DEM and its cell size, and are
+        left out of the size of the terrain entries that refer to them.
+        '''
+        horizons = None
+        if c.HORIZON_BINS:
+            cell_size = c.SIDE_LEN / elevation_array.shape[0]
+            horizons = self.cache.get_or_compute(
+                    ('horizons', dem_hash, cell_size, c.HORIZON_BINS),
+                    lambda: Horizons(elevation_array, cell_size,
+                                     n_bins=c.HORIZON_BINS)
+            )
+        key = self._terrain_key(dem_hash, dem, level)
+        return self.cache.get_or_compute(key,
+                lambda: self._calc_terrain(elevation_array, dem, horizons,
+                                           key),
+                shared=(horizons,)
+        )
 
-    def export(self):
+    def load_terrain(self, dem):
+        '''Returns elevation, slope, aspect and the Correction for the
+        named DEM, independently of the DEM currently selected.
         '''
+        if dem not in self.filelist:
+            raise ValueError(f'unknown DEM {dem!r}')
+        elevation_array, dem_hash = self._load_dem(dem)
+        slope, aspect, correct = self._get_terrain(
+                elevation_array, dem_hash, dem
+        )
+        return elevation_array, slope, aspect, correct
+
+    def _on_doc(self, func, *args):
+        '''Runs func on the session's document thread when served, so
+        that a worker thread never modifies Bokeh models directly.
         '''
-        correct_stack = self._looped_correction()
+        if self._doc is None:
+            func(*args)
+        else:
+            self._doc.add_next_tick_callback(partial(func, *args))
 
-        outfile = TemporaryFile()
-        np.savez(outfile,
-                    elevation=self.elevation_array,
-                    slope=self.slope,
-                    aspect=self.aspect,
-                    sunposition=self.correct.sunposition_df.to_numpy(),
-                    correction_stack=correct_stack,
+    def _set_progress(self, precompute_id, done, total):
+        if precompute_id == self._precompute_id:
+            self.progress.max = total
+            self.progress.value = done
+
+    def _set_terrain(self, precompute_id, terrain):
+        if precompute_id == self._precompute_id:
+            self.slope, self.aspect, self.correct = terrain
+            self.progress.name = 'Precomputing day'
+            self.progress.value = 0
+            self.terrain_ready += 1
+
+    def _set_full_stack(self, precompute_id, stack):
+        if precompute_id == self._precompute_id:
+            self.full_stack = stack
+
+    def _calc_stack(self, precompute_id, correct):
+        return correct.calc_correction_fullday(
+                workers=c.WORKERS,
+                progress=lambda done, total: self._on_doc(
+                    self._set_progress, precompute_id, done, total
+                )
         )
+
+    def _precompute(self, precompute_id, view_array, dem_hash, dem, level):
+        terrain = self._get_terrain(view_array, dem_hash, dem, level)
+        self._on_doc(self._set_terrain, precompute_id, terrain)
+
+        key = ('stack',) + self._terrain_key(dem_hash, dem, level)
+        compute = partial(self._calc_stack, precompute_id, terrain[2])
+        stack = self.cache.get_or_compute(
+                key, lambda: self._shared(key, compute)
+        )
+        self._on_doc(self._set_progress, precompute_id, 1, 1)
+        self._on_doc(self._set_full_stack, precompute_id, stack)
+
+    def _start_precompute(self):
+        '''Starts a worker thread that computes the terrain for the
+        selected DEM and then its full-day stack, or takes either from
+        the shared cache if any session already has, so that selecting
+        a DEM never blocks the session. The terrain is shown as soon as
+        it arrives; time changes become index lookups once the stack
+        finishes, and export reuses it. Results from a DEM that has
+        since been deselected are discarded. Both are at the resolution
+        of self.view_array.
+        '''
+        self._precompute_id += 1
+        self.slope = self.aspect = self.correct = None
+        self.full_stack = None
+        # indeterminate until the terrain, and so the day's timesteps,
+        # are known
+        self.progress.name = 'Computing terrain'
+        self.progress.value = -1
+        self._doc = pn.state.curdoc
+
+        threading.Thread(
+                target=self._precompute,
+                args=(self._precompute_id, self.view_array, self.dem_hash,
+                      self.DEM, self.level),
+                daemon=True
+        ).start()
+
+    @staticmethod
+    def _pending():
+        '''Placeholder for the plots of a DEM whose terrain is still
+        being computed.
+        '''
+        return pn.pane.Markdown('Computing terrain…')
+
+    @param.depends('time', 'terrain_ready')
+    def output(self):
+        '''Pushes the terrain correction array for the current time to
+        the persistent correction plot, which is returned, at the
+        resolution of self.view_array. The plot is left empty until the
+        DEM's terrain arrives from the worker thread.
+        '''
+        if self.correct is None:
+            self.correction_fig.title.text = 'Computing terrain…'
+            self.correction_source.data = {'image': [], 'dw': [], 'dh': []}
+            return self.correction_pane
+
+        n_times = self.correct.sunposition_df.shape[0]
+        self.param.time.bounds = (0, max(n_times - 1, 0))
+        if n_times == 0:
+            # no sunlit timesteps (polar night): nothing to show
+            self.correct_array = np.full(self.correct.terrain.shape,
+                                         self.correct.terrain.no_data,
+                                         dtype=self.correct.dtype)
+        elif self.full_stack is not None:
+            self.correct_array = self.full_stack[self.time]
+        else:
+            self.correct_array = self.correct.calc_correction_onetime(
+                    self.time
+            )
+
+        with instrument.stage('render') as stage:
+            rows, cols = self.elevation_array.shape
+            self.correction_fig.title.text = self._set_title(fn=self.DEM,
+                                                             opt='correction')
+            self.correction_source.data = {
+                    'image': [self._mask_no_data(self.correct_array)],
+                    'dw': [cols], 'dh': [rows]
+            }
+            stage.nbytes = self.correct_array.nbytes
+        return self.correction_pane
+
+    def _export_file(self):
+        '''Writes the export archive for the current DEM chunk by chunk,
+        always at full resolution. The precomputed full-day stack is
+        reused if it is ready and views are at full resolution;
+        otherwise only one timestep of the correction stack is held in
+        memory.
+        '''
+        elevation, slope, aspect, correct = self.load_terrain(self.DEM)
+        stack = self.full_stack if self.level == 0 else None
+        outfile = TemporaryFile()
+        with instrument.stage('export') as stage:
+            for chunk in iter_export_chunks(elevation, slope, aspect, correct,
+                                            stack=stack,
+                                            mode=self.export_mode,
+                                            quantize=self.export_quantize,
+                                            compact=self.export_compact):
+                outfile.write(chunk)
+                stage.nbytes += len(chunk)
         _ = outfile.seek(0)
+        return outfile
 
+    def export(self):
+        '''Returns a download button; the archive is only computed when
+        it is clicked. The button sends the whole archive through the
+        session, so it is held on disk and in the browser before it is
+        saved, which limits it to small DEMs. When the app is run with
+        `python main.py`, a link to /export?dem= is shown as well, which
+        streams the archive as it is computed; `panel serve` has no
+        route for it, and larger DEMs are left to batch.py.
+        '''
         name = f'{self.DEM[:-4]}_correction.npz'
-        return pn.widgets.FileDownload(file=outfile, filename=name)
+        download = pn.widgets.FileDownload(callback=self._export_file,
+                                           filename=name)
+        if STREAM_EXPORT:
+            query = urlencode({'dem': self.DEM, 'mode': self.export_mode,
+                               'quantize': self.export_quantize,
+                               'compact': int(self.export_compact)})
+            note = (f'Large DEMs: [stream the archive](/export?{query}) '
+                    'instead.')
+        else:
+            note = ('The download is built whole before it is sent; '
+                    'export large DEMs with `python batch.py`.')
+        return pn.Column(download, pn.pane.Markdown(note))
     
+    @param.depends('terrain_ready')
     def plot_slope(self):
         '''Return a plot of the self.slope array
         '''        
+        if self.slope is None:
+            return self._pending()
         return self._imshow(array=self.slope, cmap='YlOrBr', opt='slope')
 
+    @param.depends('terrain_ready')
     def plot_aspect(self):
         '''Return a plot of the self.aspect array
         '''
+        if self.aspect is None:
+            return self._pending()
         return self._imshow(array=self.aspect, cmap='hsv', opt='aspect')
 
+    @param.depends('terrain_ready')
     def plot_sun(self):
         '''Return a plot of sun position
         '''
+        if self.correct is None:
+            return self._pending()
         xs = np.deg2rad(self.correct.sunposition_df['azimuth'])
         ys = self.correct.sunposition_df['altitude']
         
-        fig = plt.figure()
-        ax = fig.add_subplot(111, projection='polar')
-        ax.scatter(xs,ys, s=10, c='orange',alpha=0.5)
-        self._format_polar(fig=fig, ax=ax)
-        plt.close('all')
+        with instrument.stage('render'):
+            fig = plt.figure()
+            ax = fig.add_subplot(111, projection='polar')
+            ax.scatter(xs,ys, s=10, c='orange',alpha=0.5)
+            self._format_polar(fig=fig, ax=ax)
+            plt.close('all')
         return fig
 
+    def diagnostics(self):
+        '''Returns a panel showing instrument.snapshot(), the time, call
+        count and bytes of each stage across every session served by
+        this process, with a button to refresh it.
+        '''
+        pane = pn.pane.JSON(instrument.snapshot(), depth=2, theme='dark')
+        refresh = pn.widgets.Button(name='Refresh diagnostics')
+
+        def update(event):
+            pane.object = instrument.snapshot()
+
+        refresh.on_click(update)
+        return pn.Column(refresh, pane)
 
-interact = Interact()
 
-input_params = [interact.param.DEM,]
-output_params = [interact.param.time,]
+def make_template():
+    '''Builds the template, with its own Interact, for one session, so
+    that no two sessions share a selected DEM, time, progress bar or
+    precomputed stack. The caches behind them are shared by all.
+    '''
+    tmpl = pn.Template(template)
+    tmpl.add_variable('app_title', name)
+    tmpl.add_variable('description', description)
+    tmpl.add_variable('blockquote', blockquote)
+    tmpl.add_variable('extras', extras)
+    tmpl.add_variable('returns', returns)
+    tmpl.add_variable('js', js)
+    tmpl.add_variable('diagnostics', c.INSTRUMENT)
+
+    interact = Interact()
 
-tmpl.add_panel('A', pn.Column(interact.input, *input_params))
-tmpl.add_panel('B', pn.Column(interact.output, *output_params))
-tmpl.add_panel('C', interact.export)
-tmpl.add_panel('D', interact.plot_slope)
-tmpl.add_panel('E', interact.plot_aspect)
-tmpl.add_panel('F', interact.plot_sun)
+    input_params = [interact.param.DEM, interact.param.full_resolution]
+    output_params = [interact.param.time, interact.progress]
 
-tmpl.servable()
+    tmpl.add_panel('A', pn.Column(interact.input, *input_params))
+    tmpl.add_panel('B', pn.Column(interact.output, *output_params))
+    tmpl.add_panel('C', pn.Column(interact.param.export_mode,
+                                  interact.param.export_quantize,
+                                  interact.param.export_compact,
+                                  interact.export))
+    tmpl.add_panel('D', interact.plot_slope)
+    tmpl.add_panel('E', interact.plot_aspect)
+    tmpl.add_panel('F', interact.plot_sun)
+    if c.INSTRUMENT:
+        tmpl.add_panel('G', interact.diagnostics())
+    return tmpl
+
+if __name__ == '__main__':
+    # the export handler serves any DEM by name, so it has an Interact
+    # of its own, used only for load_terrain
+    STREAM_EXPORT = True
+    export_handler = make_export_handler(Interact().load_terrain)
+    extra_patterns = [(r'/export', export_handler)]
+    if c.INSTRUMENT:
+        extra_patterns.append(
+                (r'/diagnostics', instrument.make_diagnostics_handler())
+        )
+    pn.serve({name: make_template}, extra_patterns=extra_patterns)
+else:
+    make_template().servable()
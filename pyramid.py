@@ -0,0 +1,51 @@
+import numpy as np
+
+def downsample(grid, no_data=-9999, strip=512):
+    '''
+    Halves a grid with the mean of each 2x2 block, ignoring nodata and
+    nan cells; blocks with no valid cells are nodata. A grid with an odd
+    number of rows or columns is padded with nodata. The grid is read
+    strip rows of the output at a time, so a memory-mapped DEM is never
+    loaded whole.
+    '''
+    rows, cols = grid.shape
+    out = np.empty(((rows + 1)//2, (cols + 1)//2))
+    for r in range(0, out.shape[0], strip):
+        block = np.full((2*min(strip, out.shape[0] - r), 2*out.shape[1]),
+                        np.nan)
+        src = np.asarray(grid[2*r:2*(r + strip)], dtype=np.float64)
+        block[:src.shape[0], :cols] = src
+        block[block == no_data] = np.nan
+
+        blocks = block.reshape(block.shape[0]//2, 2, out.shape[1], 2)
+        valid = ~np.isnan(blocks)
+        counts = valid.sum(axis=(1, 3))
+        sums = np.where(valid, blocks, 0.).sum(axis=(1, 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[r:r + strip] = np.where(counts > 0, sums/counts, no_data)
+    return out
+
+class Pyramid():
+    '''
+    Overview levels of a DEM for interactive previews. levels[0] is the
+    DEM itself, and each further level halves the one before it (see
+    downsample), down to the first level no more than min_size cells
+    along its longer side. Slope, aspect and corrections for a preview
+    are computed from the level's DEM, with its coarser cell size,
+    rather than downsampled from the full-resolution grids.
+    '''
+    def __init__(self, grid, min_size=512, no_data=-9999):
+        self.levels = [grid]
+        while max(self.levels[-1].shape) > max(min_size, 1):
+            self.levels.append(downsample(self.levels[-1], no_data))
+
+    def level_for(self, size):
+        '''
+        index of the coarsest level with at least size cells along its
+        longer side, i.e. the cheapest level that still fills a display
+        of that many pixels; 0 if the DEM itself is smaller.
+        '''
+        for i in range(len(self.levels) - 1, 0, -1):
+            if max(self.levels[i].shape) >= size:
+                return i
+        return 0
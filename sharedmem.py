@@ -0,0 +1,125 @@
+import hashlib
+import json
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# bytes reserved at the start of each segment for a JSON header with
+# the array's dtype and shape; a reader that finds it empty knows the
+# writer has not finished
+_HEADER = 256
+
+# a weak reference to the array viewing each segment open in this
+# process. The segment stays open for as long as that array (or any
+# view of it) is alive, and is closed once it is collected, e.g. after
+# its cache entry is evicted; the process that created it also unlinks
+# it then.
+_segments = {}
+
+def segment_name(key):
+    '''
+    returns a short, portable segment name for a cache key, such as
+    one starting with a DEM's content hash.
+    '''
+    return 'ufc_' + hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+
+def _open(name, create=False, size=0):
+    # only the creator registers the segment for removal should the
+    # process exit without releasing it
+    try:
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size,
+                                         track=create)
+    except TypeError:
+        # before Python 3.13, every process that opens a segment also
+        # registers it
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        if not create:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+def _release(name, shm, created):
+    if _segments.get(name) is not None and _segments[name]() is None:
+        del _segments[name]
+    try:
+        shm.close()
+    except BufferError:
+        pass
+    if created:
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+def _view(shm):
+    header = bytes(shm.buf[:_HEADER]).rstrip(b'\0')
+    if not header:
+        raise FileNotFoundError(f'shared memory segment {shm.name} not ready')
+    meta = json.loads(header)
+    array = np.ndarray(tuple(meta['shape']), dtype=np.dtype(meta['dtype']),
+                       buffer=shm.buf, offset=_HEADER)
+    array.flags.writeable = False
+    return array
+
+def _track(name, shm, array, created=False):
+    _segments[name] = weakref.ref(array)
+    weakref.finalize(array, _release, name, shm, created)
+    return array
+
+def _live(name):
+    ref = _segments.get(name)
+    return None if ref is None else ref()
+
+def attach(name):
+    '''
+    Returns a read-only, zero-copy view of the array published under
+    name. Raises FileNotFoundError if there is no such segment, or if
+    its writer has not finished.
+    '''
+    array = _live(name)
+    if array is not None:
+        return array
+    shm = _open(name)
+    try:
+        array = _view(shm)
+    except FileNotFoundError:
+        shm.close()
+        raise
+    return _track(name, shm, array)
+
+def publish(name, array):
+    '''
+    Copies array into a new segment and returns a read-only view of
+    it. If another process has already published name, its array is
+    returned instead.
+    '''
+    array = np.ascontiguousarray(array)
+    header = json.dumps(
+        {'dtype': array.dtype.str, 'shape': array.shape}
+    ).encode()
+    try:
+        shm = _open(name, create=True, size=_HEADER + max(array.nbytes, 1))
+    except FileExistsError:
+        return attach(name)
+
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf,
+               offset=_HEADER)[...] = array
+    # the header goes last, marking the segment as complete
+    shm.buf[:len(header)] = header
+    return _track(name, shm, _view(shm), created=True)
+
+def get_or_publish(name, func):
+    '''
+    Returns the array published under name, attaching to it if it
+    exists, and otherwise computing it with func() and publishing it.
+    '''
+    try:
+        return attach(name)
+    except FileNotFoundError:
+        pass
+    array = func()
+    try:
+        return publish(name, array)
+    except FileNotFoundError:
+        # another process created the segment and is still writing it
+        return array
@@ -6,7 +6,30 @@ The returned file is an <code>.npz</code> archive containing:
     <li><code>aspect</code>: 2D aspect array;</li>
     <li><code>sunposition</code>: tablular sun position data for all sunlit 
 timepoints on the selected day;</li>
-    <li><code>correction_stack</code>: 3D array of correction rasters for each of 
-the sunlit timepoints.</li>
+    <li><code>correction_000</code>, <code>correction_001</code>, ...: 2D 
+correction rasters, one per sunlit timepoint, which can be read individually. 
+<code>export.load_correction_stack()</code> reassembles them into a 3D 
+array.</li>
 </ul>
+With the <code>aggregates</code> export mode, the per-timepoint rasters are 
+replaced by daily reductions over time: <code>daily_sum</code>, 
+<code>daily_mean</code>, <code>daily_max</code>, and 
+<code>daily_weighted_sum</code>/<code>daily_weighted_mean</code>, which weight 
+each timepoint by the cosine of the solar zenith angle. <code>both</code> 
+includes all of the above.
+<br>
+The <code>quantize</code> option shrinks the archive several-fold: with 
+<code>stack</code>, the correction and daily rasters are stored as 16-bit 
+integers, each with a <code>&lt;name&gt;_quantization</code> member holding 
+its scale and offset, in a compressed archive; <code>all</code> also 
+quantizes slope and aspect. Each value is reproduced to within half its 
+array's scale, i.e. 1/131068 of the array's range. 
+<code>export.read_member()</code> and 
+<code>export.load_correction_stack()</code> dequantize on read.
+<br>
+The <code>compact</code> option stores the correction and daily rasters as 
+1D arrays of the DEM's valid (non-nodata) cells only, with their flat 
+indices in <code>valid_index</code> and the raster shape in 
+<code>grid_shape</code>; the same functions scatter them back into full 
+rasters, with -9999 in the invalid cells.
 """
\ No newline at end of file
@@ -0,0 +1,264 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+def _to_unix_seconds(utc_datetimes):
+    '''
+    converts an array-like of naive UTC datetime64 values into
+    float seconds since the unix epoch.
+    '''
+    dts = np.asarray(utc_datetimes, dtype='datetime64[ns]')
+    return dts.astype('int64') / 1e9
+
+def _refraction(elevation):
+    '''
+    atmospheric refraction correction (degrees) at standard temperature
+    and pressure, using the same formula as NREL's SPA (and therefore
+    pysolar), so the two backends agree near the horizon.
+    '''
+    pressure, temperature = 1013.25, 288.15
+    sun_radius, atmos_refract = 0.26667, 0.5667
+    with np.errstate(divide='ignore', invalid='ignore'):
+        del_e = (
+            (pressure/1010.) * (283./temperature) * 1.02
+            / (60. * np.tan(np.deg2rad(elevation + 10.3/(elevation + 5.11))))
+        )
+    return np.where(elevation >= -(sun_radius + atmos_refract), del_e, 0.)
+
+def noaa_sunposition(utc_datetimes, lat, lon):
+    '''
+    Vectorized solar ephemeris after the NOAA solar calculator
+    (Meeus, Astronomical Algorithms), evaluated for every timestamp
+    in one pass.
+
+    Validated against pysolar (NREL SPA) for sunlit instants between
+    1950 and 2090 at latitudes from -35 to 65: altitude agrees to
+    within 0.03 degrees, and azimuth to within 0.15 degrees for solar
+    altitudes below 85 degrees. Azimuth is ill-conditioned as the sun
+    approaches the zenith, but its weight in the correction (sinT0)
+    vanishes there too.
+
+    Parameters
+    ==========
+    utc_datetimes : array-like of datetime64
+        naive datetimes in UTC
+    lat, lon : float
+        degrees, north and east positive
+
+    Returns
+    =======
+    altitude, azimuth : ndarray
+        refraction-corrected solar elevation angle in degrees, and
+        azimuth in degrees clockwise from north (pysolar conventions)
+    '''
+    seconds = _to_unix_seconds(utc_datetimes)
+
+    jd = seconds/86400. + 2440587.5
+    jc = (jd - 2451545.)/36525.
+
+    mean_long = np.mod(280.46646 + jc*(36000.76983 + jc*0.0003032), 360)
+    mean_anom = 357.52911 + jc*(35999.05029 - 0.0001537*jc)
+    ecc = 0.016708634 - jc*(0.000042037 + 0.0000001267*jc)
+    M = np.deg2rad(mean_anom)
+
+    eq_ctr = (
+        np.sin(M)*(1.914602 - jc*(0.004817 + 0.000014*jc))
+        + np.sin(2*M)*(0.019993 - 0.000101*jc)
+        + np.sin(3*M)*0.000289
+    )
+    omega = np.deg2rad(125.04 - 1934.136*jc)
+    app_long = mean_long + eq_ctr - 0.00569 - 0.00478*np.sin(omega)
+
+    mean_obliq = 23 + (
+        26 + (21.448 - jc*(46.815 + jc*(0.00059 - jc*0.001813)))/60
+    )/60
+    obliq = np.deg2rad(mean_obliq + 0.00256*np.cos(omega))
+
+    decl = np.arcsin(np.sin(obliq)*np.sin(np.deg2rad(app_long)))
+
+    y = np.tan(obliq/2)**2
+    L0 = np.deg2rad(mean_long)
+    eq_time = 4*np.rad2deg(
+        y*np.sin(2*L0)
+        - 2*ecc*np.sin(M)
+        + 4*ecc*y*np.sin(M)*np.cos(2*L0)
+        - 0.5*y*y*np.sin(4*L0)
+        - 1.25*ecc*ecc*np.sin(2*M)
+    )
+
+    minutes = np.mod(seconds, 86400.)/60.
+    true_solar_time = np.mod(minutes + eq_time + 4*lon, 1440.)
+    hour_angle = np.deg2rad(true_solar_time/4 - 180)
+
+    phi = np.deg2rad(lat)
+    cos_zen = np.clip(
+        np.sin(phi)*np.sin(decl) + np.cos(phi)*np.cos(decl)*np.cos(hour_angle),
+        -1, 1
+    )
+    zen = np.arccos(cos_zen)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos_azi = np.clip(
+            (np.sin(phi)*cos_zen - np.sin(decl)) / (np.cos(phi)*np.sin(zen)),
+            -1, 1
+        )
+    azi = np.rad2deg(np.arccos(cos_azi))
+    azimuth = np.where(
+        hour_angle > 0, np.mod(azi + 180, 360), np.mod(540 - azi, 360)
+    )
+
+    elevation = 90 - np.rad2deg(zen)
+    altitude = elevation + _refraction(elevation)
+
+    return altitude, azimuth
+
+def _unrefract(altitude):
+    '''
+    inverts _refraction: the geometric elevation (degrees) whose
+    refraction-corrected altitude is altitude, by fixed-point iteration.
+    Altitudes below the cutoff of _refraction were never refracted.
+    '''
+    altitude = np.asarray(altitude, dtype=np.float64)
+    cutoff = -(0.26667 + 0.5667)
+    elevation = altitude
+    for _ in range(10):
+        elevation = np.where(
+            altitude >= cutoff,
+            altitude - _refraction(np.maximum(elevation, cutoff)),
+            altitude
+        )
+    return elevation
+
+def _to_equatorial(elevation, azimuth, lat):
+    '''
+    hour angle (west positive) and declination, radians, of a direction
+    given by its geometric elevation and azimuth (degrees).
+    '''
+    h, A, phi = np.deg2rad(elevation), np.deg2rad(azimuth), np.deg2rad(lat)
+    east, north, up = np.cos(h)*np.sin(A), np.cos(h)*np.cos(A), np.sin(h)
+    decl = np.arcsin(np.clip(north*np.cos(phi) + up*np.sin(phi), -1, 1))
+    hour_angle = np.arctan2(-east, up*np.cos(phi) - north*np.sin(phi))
+    return hour_angle, decl
+
+def _from_equatorial(hour_angle, decl, lat):
+    '''
+    inverse of _to_equatorial, returning elevation and azimuth in degrees.
+    '''
+    phi = np.deg2rad(lat)
+    east = -np.cos(decl)*np.sin(hour_angle)
+    north = (np.cos(phi)*np.sin(decl)
+             - np.sin(phi)*np.cos(decl)*np.cos(hour_angle))
+    up = np.sin(phi)*np.sin(decl) + np.cos(phi)*np.cos(decl)*np.cos(hour_angle)
+    elevation = np.rad2deg(np.arcsin(np.clip(up, -1, 1)))
+    azimuth = np.mod(np.rad2deg(np.arctan2(east, north)), 360)
+    return elevation, azimuth
+
+def interpolate_sunposition(node_seconds, altitude, azimuth, seconds, lat):
+    '''
+    Sun positions at arbitrary instants, interpolated from a sparse
+    exact ephemeris (e.g. hourly positions from one of BACKENDS).
+
+    Interpolating altitude and azimuth directly is poor near the
+    horizon (refraction) and near the zenith (azimuth swings). Instead,
+    the nodes are de-refracted and rotated into hour angle and
+    declination, which over a day are almost exactly linear and
+    constant respectively, interpolated linearly there, and rotated
+    back. With nodes an hour apart, the result agrees with the
+    ephemeris itself to within 2e-6 degrees in altitude and 1e-5
+    degrees in azimuth (2e-4 within a degree or so of the zenith, where
+    azimuth is ill-conditioned), at any latitude; the error shrinks
+    with the square of the node spacing.
+
+    Parameters
+    ==========
+    node_seconds : array-like, increasing
+        instants of the nodes, in seconds (e.g. since the unix epoch)
+    altitude, azimuth : array-like
+        sun position at the nodes, as returned by a backend
+    seconds : array-like
+        instants to interpolate, within the span of node_seconds
+    lat : float
+        degrees, north positive
+
+    Returns
+    =======
+    altitude, azimuth : ndarray
+        with the same conventions as the backends
+    '''
+    hour_angle, decl = _to_equatorial(_unrefract(altitude), azimuth, lat)
+    hour_angle = np.unwrap(hour_angle)
+    elevation, azimuth = _from_equatorial(
+        np.interp(seconds, node_seconds, hour_angle),
+        np.interp(seconds, node_seconds, decl),
+        lat
+    )
+    return elevation + _refraction(elevation), azimuth
+
+def sunlit_intervals(node_seconds, altitude, azimuth, lat, tol=0.5):
+    '''
+    Solves for sunrise and sunset (altitude == 0, refraction included)
+    between the nodes of a sparse ephemeris, by bisection on
+    interpolate_sunposition.
+
+    Returns
+    =======
+    ndarray, shape == (n, 2)
+        (start, end) seconds of each interval in which the sun is up,
+        to within tol seconds; an interval open at either end of the
+        nodes' span (polar day) starts or ends there.
+    '''
+    node_seconds = np.asarray(node_seconds, dtype=np.float64)
+    up = np.asarray(altitude) > 0
+    crossings = np.flatnonzero(up[1:] != up[:-1])
+
+    lo, hi = node_seconds[crossings], node_seconds[crossings + 1]
+    rising = up[crossings + 1]
+    while np.any(hi - lo > tol):
+        mid = (lo + hi) / 2
+        mid_up = interpolate_sunposition(
+            node_seconds, altitude, azimuth, mid, lat
+        )[0] > 0
+        # keep the half whose ends still straddle the horizon
+        keep_lo = mid_up == rising
+        lo, hi = np.where(keep_lo, lo, mid), np.where(keep_lo, mid, hi)
+    roots = (lo + hi) / 2
+
+    starts = list(roots[rising])
+    ends = list(roots[~rising])
+    if up[0]:
+        starts.insert(0, node_seconds[0])
+    if up[-1]:
+        ends.append(node_seconds[-1])
+    return np.column_stack((starts, ends)).reshape(-1, 2)
+
+def pysolar_sunposition(utc_datetimes, lat, lon):
+    '''
+    Reference backend: calls pysolar once per timestamp. Same signature
+    and return conventions as noaa_sunposition.
+    '''
+    from pysolar import solar
+
+    dts = [
+        datetime.fromtimestamp(s, tz=timezone.utc)
+        for s in _to_unix_seconds(utc_datetimes)
+    ]
+    altitude = np.array([solar.get_altitude(lat, lon, dt) for dt in dts])
+    azimuth = np.array([solar.get_azimuth(lat, lon, dt) for dt in dts])
+    return altitude, azimuth
+
+BACKENDS = {
+    'noaa': noaa_sunposition,
+    'pysolar': pysolar_sunposition,
+}
+
+def get_backend(name):
+    '''
+    returns the sun position function registered under name.
+    '''
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            f'unknown sun position backend {name!r}, '
+            f'expected one of {sorted(BACKENDS)}'
+        )
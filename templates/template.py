@@ -39,6 +39,11 @@ template = """
       <blockquote>{{ returns }}</blockquote>
       <br>
     </div>
+    {% if diagnostics %}
+    <div id="diagnostics" class="row centered">
+        {{ embed(roots.G) }}
+    </div>
+    {% endif %}
   </div>
 </div>
 
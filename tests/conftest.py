@@ -0,0 +1,18 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the modules under test live at the top of the repository
+sys.path.insert(0, ROOT)
+
+SAMPLE_DEM = os.path.join(ROOT, 'data', '20190623_NNR300S20.npy')
+
+@pytest.fixture
+def sample_dem():
+    '''the sample DEM in data/, and its cell size (SIDE_LEN / rows).'''
+    dem = np.load(SAMPLE_DEM)
+    return dem, 3 / dem.shape[0]
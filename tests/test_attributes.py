@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from attributes import Attributes
+
+def _attributes(dem, backend='numpy', cell_size=0.01):
+    return Attributes(dem, resolution=dem.shape[0], projection='WGS84',
+                      side_len=dem.shape[0]*cell_size, backend=backend)
+
+def _horn(dem, cell_size, no_data=-9999):
+    # the stencil cell by cell, with missing neighbours replaced by the
+    # central cell, as richdem does
+    rows, cols = dem.shape
+    slope = np.full(dem.shape, float(no_data))
+    aspect = np.full(dem.shape, float(no_data))
+    for r in range(rows):
+        for c in range(cols):
+            e = dem[r, c]
+            if e == no_data:
+                continue
+            z = np.full((3, 3), e)
+            for dr in (-1, 0, 1):
+                for dc in (-1, 0, 1):
+                    rr, cc = r + dr, c + dc
+                    if 0 <= rr < rows and 0 <= cc < cols and \
+                            dem[rr, cc] != no_data:
+                        z[dr + 1, dc + 1] = dem[rr, cc]
+            dzdx = (z[:, 2] @ [1, 2, 1] - z[:, 0] @ [1, 2, 1]) / 8 / cell_size
+            dzdy = (z[2] @ [1, 2, 1] - z[0] @ [1, 2, 1]) / 8 / cell_size
+            slope[r, c] = np.arctan(np.hypot(dzdx, dzdy))
+            if dzdx == 0 and dzdy == 0:
+                aspect[r, c] = -1
+                continue
+            a = np.rad2deg(np.arctan2(dzdy, -dzdx))
+            a = 450 - a if a > 90 else 90 - a
+            aspect[r, c] = a - 360 if a > 180 else a
+    return slope, aspect
+
+def test_numpy_backend_edges_and_nodata():
+    rng = np.random.default_rng(0)
+    dem = 100 + np.cumsum(rng.normal(0, 0.01, (12, 15)), axis=1)
+    dem[4:6, 6:9] = -9999
+    dem[0, 0] = -9999
+    slope, aspect = _attributes(dem).calc_attributes()
+    expected_slope, expected_aspect = _horn(dem, 0.01)
+
+    assert slope.dtype == aspect.dtype == np.float32
+    np.testing.assert_allclose(slope, expected_slope, rtol=1e-6)
+    np.testing.assert_allclose(aspect, expected_aspect, rtol=1e-5, atol=1e-4)
+    assert np.all(slope[dem == -9999] == -9999)
+    assert np.all(aspect[dem == -9999] == -9999)
+
+def test_numpy_backend_flat_aspect():
+    slope, aspect = _attributes(np.full((5, 6), 2940.)).calc_attributes()
+    assert np.all(slope == 0)
+    assert np.all(aspect == -1)
+
+def test_numpy_backend_matches_richdem(sample_dem):
+    pytest.importorskip('richdem')
+    dem, cell_size = sample_dem
+    dem = dem.copy()
+    dem[100:120, 40:90] = -9999
+    dem[0, :10] = -9999
+
+    slope, aspect = _attributes(dem, 'numpy', cell_size).calc_attributes()
+    rd_slope, rd_aspect = _attributes(dem, 'richdem',
+                                      cell_size).calc_attributes()
+    np.testing.assert_allclose(slope, rd_slope, rtol=1e-5, atol=1e-6)
+    # aspect wraps at +-180 degrees
+    diff = (aspect - rd_aspect + 180) % 360 - 180
+    assert np.abs(diff).max() < 1e-3
+    assert np.array_equal(slope == -9999, rd_slope == -9999)
+    assert np.array_equal(aspect == -9999, rd_aspect == -9999)
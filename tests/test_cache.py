@@ -0,0 +1,39 @@
+import threading
+import time
+
+import numpy as np
+
+from cache import LRUCache, nbytes
+
+def test_nbytes_counts_views_once():
+    array = np.zeros(1000)
+    assert nbytes((array, array[10:], array.reshape(10, 100))) == array.nbytes
+
+def test_shared_objects_are_not_counted():
+    cache = LRUCache()
+    shared = np.zeros(1000)
+    cache.put('a', (shared, shared[::2], np.zeros(10)), shared=(shared,))
+    assert cache.stats()['bytes'] == 80
+
+def test_waiters_get_a_value_too_large_to_store():
+    cache = LRUCache(max_bytes=10)
+    calls = []
+
+    def compute():
+        calls.append(None)
+        time.sleep(0.1)
+        return np.zeros(100)
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.get_or_compute('a', compute))
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(results) == 4 and 'a' not in cache
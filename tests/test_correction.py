@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+from correction import Correction
+
+EPS32 = np.finfo(np.float32).eps
+
+def _grids(shape=(64, 64), seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(0, 60, shape), rng.uniform(-180, 180, shape)
+
+def _correction(dtype, grids):
+    return Correction(grids, 'America/Los_Angeles', '20190623',
+                      (37.643, -119.029), sun_backend='noaa',
+                      time_step='5min', dtype=dtype)
+
+def test_float32_error_bound():
+    # the bound documented on PreparedTerrain, checked at every timestep
+    grids = _grids()
+    single = _correction(np.float32, grids)
+    double = _correction(np.float64, grids)
+    stack32 = single.calc_correction_fullday()
+    stack64 = double.calc_correction_fullday()
+    assert stack32.dtype == np.float32
+
+    zenith = np.deg2rad(double.sunposition_df['altitude'].to_numpy())
+    bound = 4*EPS32*(1 + 2*np.tan(zenith))
+    error = np.abs(stack32 - stack64).max(axis=(1, 2))
+    assert np.all(error <= bound)
+
+    for i in range(len(zenith)):
+        error = np.abs(single.calc_correction_onetime(i)
+                       - double.calc_correction_onetime(i)).max()
+        assert error <= bound[i]
+
+def test_shared_terrain_skips_nodata():
+    from horizon import Horizons
+    from correction import PreparedTerrain
+
+    rng = np.random.default_rng(1)
+    dem = np.cumsum(rng.normal(0, 0.05, (40, 50)), axis=0) + 10
+    dem[10:12, 20:25] = -9999
+    slope, aspect = _grids((40, 50))
+    slope[dem == -9999] = -9999
+    horizons = Horizons(dem, 0.1, n_bins=8)
+    terrain = PreparedTerrain(slope, aspect, horizons=horizons)
+    assert terrain.n_cells == dem.size - 10
+
+    for date_str in ('20190623', '20191222'):
+        kwargs = dict(local_timezone='America/Los_Angeles',
+                      date_str=date_str, lat_lon=(37.643, -119.029),
+                      sun_backend='noaa')
+        shared = Correction((slope, aspect), terrain=terrain, **kwargs)
+        own = Correction((slope, aspect), horizons=horizons, **kwargs)
+        stack = shared.calc_correction_fullday()
+        np.testing.assert_array_equal(stack, own.calc_correction_fullday())
+        assert np.all(stack[:, dem == -9999] == -9999)
+        assert shared.terrain is terrain
+
+def _sample_correction(sample_dem, horizons=False, **kwargs):
+    from attributes import Attributes
+    from horizon import Horizons
+
+    dem, cell_size = sample_dem
+    grids = Attributes(dem, resolution=dem.shape[0], projection='WGS84',
+                       side_len=dem.shape[0]*cell_size, backend='numpy'
+                       ).calc_attributes()
+    return Correction(grids, 'America/Los_Angeles', '20190623',
+                      (37.643, -119.029), sun_backend='noaa',
+                      horizons=Horizons(dem, cell_size) if horizons else None,
+                      **kwargs)
+
+@pytest.mark.parametrize('horizons', [False, True])
+def test_fullday_matches_onetime(sample_dem, horizons):
+    correct = _sample_correction(sample_dem, horizons)
+    stack = correct.calc_correction_fullday()
+    looped = np.stack([
+        correct.calc_correction_onetime(i)
+        for i in range(correct.sunposition_df.shape[0])
+    ])
+    assert stack.dtype == looped.dtype == np.float64
+    np.testing.assert_allclose(stack, looped, rtol=0, atol=1e-12)
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_threaded_fullday_is_bit_identical(sample_dem, dtype):
+    correct = _sample_correction(sample_dem, horizons=True, dtype=dtype)
+    serial = correct.calc_correction_fullday()
+    assert serial.dtype == dtype
+    assert np.array_equal(serial, correct.calc_correction_fullday(workers=8))
+
+@pytest.mark.parametrize('reuse_stack', [False, True])
+def test_daily_aggregates_match_fullday(sample_dem, reuse_stack):
+    correct = _sample_correction(sample_dem, horizons=True)
+    stack = correct.calc_correction_fullday()
+    aggregates = correct.calc_daily_aggregates(
+        stack=stack if reuse_stack else None
+    )
+    weights = np.cos(np.deg2rad(correct.sunposition_df['altitude']
+                                .to_numpy()))[:, np.newaxis, np.newaxis]
+    expected = {
+        'sum': stack.sum(axis=0),
+        'mean': stack.mean(axis=0),
+        'max': stack.max(axis=0),
+        'weighted_sum': (stack*weights).sum(axis=0),
+        'weighted_mean': (stack*weights).sum(axis=0) / weights.sum(),
+    }
+    for stat, array in expected.items():
+        np.testing.assert_allclose(aggregates[stat], array, rtol=1e-12,
+                                   atol=1e-12)
+
+@pytest.mark.filterwarnings('error')
+def test_daily_aggregates_in_polar_night():
+    grids = _grids((4, 5))
+    correct = Correction(grids, 'Europe/Oslo', '20191222', (78.2, 15.6),
+                         sun_backend='noaa')
+    assert correct.sunposition_df.shape[0] == 0
+    aggregates = correct.calc_daily_aggregates()
+    assert np.all(aggregates['sum'] == 0)
+    assert np.all(aggregates['weighted_sum'] == 0)
+    for stat in ('mean', 'max', 'weighted_mean'):
+        assert np.all(np.isnan(aggregates[stat]))
@@ -0,0 +1,81 @@
+import io
+
+import numpy as np
+import pytest
+
+from correction import Correction
+import export
+from export import (dequantize, iter_export_chunks, iter_npz_chunks,
+                    load_correction_stack, quantize)
+
+def _export(correct, **kwargs):
+    slope, aspect = correct.attribute_grids
+    elevation = np.zeros_like(slope)
+    return io.BytesIO(b''.join(
+        iter_export_chunks(elevation, slope, aspect, correct, **kwargs)
+    ))
+
+def test_load_correction_stack_order_past_1000_timesteps():
+    # one-minute steps in the arctic summer give 1440 timesteps, whose
+    # member names outgrow their three digits of zero padding
+    rng = np.random.default_rng(0)
+    grids = (rng.uniform(0, 30, (3, 4)), rng.uniform(-180, 180, (3, 4)))
+    correct = Correction(grids, 'Europe/Oslo', '20190623', (69.6, 18.9),
+                         sun_backend='noaa', time_step='1min')
+    assert correct.sunposition_df.shape[0] > 1000
+
+    stack = load_correction_stack(_export(correct))
+    expected = np.moveaxis(correct.calc_correction_fullday(), 0, -1)
+    np.testing.assert_allclose(stack, expected, rtol=1e-12, atol=1e-12)
+
+@pytest.mark.parametrize('dtype', [np.int16, np.uint16])
+def test_quantize_round_trip(dtype):
+    rng = np.random.default_rng(0)
+    array = rng.normal(1, 2, (50, 60))
+    array[3, :10] = -9999
+    array[7, 5] = np.nan
+
+    q, quantization = quantize(array, dtype)
+    assert q.dtype == dtype
+    restored = dequantize(q, quantization)
+
+    invalid = (array == -9999) | np.isnan(array)
+    assert np.all(restored[invalid] == -9999)
+    scale = quantization[0]
+    error = np.abs(restored[~invalid] - array[~invalid])
+    assert error.max() <= scale/2 * (1 + 1e-9)
+
+def test_quantize_without_no_data_restores_nan():
+    array = np.array([0., 1., np.inf, -9999])
+    q, quantization = quantize(array, no_data=None)
+    restored = dequantize(q, quantization)
+    assert np.isnan(restored[2]) and restored[3] == -9999
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_npz_chunks_split_members(monkeypatch, compress):
+    # small chunks, so each member is written over many of them
+    monkeypatch.setattr(export, 'CHUNK_BYTES', 1000)
+    members = {
+        'grid': np.arange(10000.).reshape(100, 100),
+        'fortran': np.asfortranarray(np.arange(600, dtype=np.int16)
+                                     .reshape(20, 30)),
+        'strided': np.arange(300.)[::3],
+        'scalar': np.float32(3),
+        'empty': np.zeros((0, 5)),
+    }
+    chunks = list(iter_npz_chunks(members.items(), compress=compress))
+    assert len(chunks) > 2 * len(members)
+    if not compress:
+        assert max(map(len, chunks)) < 2000
+
+    with np.load(io.BytesIO(b''.join(chunks))) as npz:
+        for name, array in members.items():
+            assert npz[name].dtype == array.dtype
+            np.testing.assert_array_equal(npz[name], array)
+
+def test_load_correction_stack_without_timesteps():
+    # polar night: no sunlit timesteps, so no correction members
+    grids = (np.zeros((3, 4)), np.zeros((3, 4)))
+    correct = Correction(grids, 'Europe/Oslo', '20191222', (78.2, 15.6),
+                         sun_backend='noaa')
+    assert load_correction_stack(_export(correct)).shape == (3, 4, 0)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from attributes import Attributes
+from correction import Correction
+from horizon import Horizons, _scan_lines
+
+def _brute_force(z, dist):
+    # the steepest valid point beyond each valid point, by exhaustion
+    n_lines, n = z.shape
+    tan_h = np.full(z.shape, -np.inf)
+    for line in range(n_lines):
+        for i in range(n):
+            if not np.isfinite(z[line, i]):
+                continue
+            for k in range(i + 1, n):
+                if np.isfinite(z[line, k]):
+                    slope = (z[line, k] - z[line, i]) / dist(i, k)
+                    tan_h[line, i] = max(tan_h[line, i], slope)
+    return tan_h
+
+def test_scan_lines_across_nodata_gaps():
+    rng = np.random.default_rng(0)
+    z = np.cumsum(rng.normal(0, 1, (40, 50)), axis=1)
+    # interior gaps one to six cells wide, and lines starting or ending
+    # off the grid
+    for line in range(z.shape[0]):
+        start = rng.integers(1, 40)
+        z[line, start:start + line % 6 + 1] = -np.inf
+    z[::7, :3] = -np.inf
+    z[::5, -4:] = -np.inf
+
+    def dist(i, j):
+        return 0.5 * (j - i)
+
+    np.testing.assert_allclose(_scan_lines(z, dist), _brute_force(z, dist))
+
+@pytest.mark.parametrize('axis, time, sun_side', [(0, None, -1), (1, 8, 1)])
+def test_cast_shadows_fall_away_from_the_sun(axis, time, sun_side):
+    # a ridge across the DEM, lit at winter noon from the south (axis 0,
+    # row 0 being the southern edge) or in the morning from the
+    # south-east (axis 1, columns increasing eastwards)
+    n, cell_size = 100, 0.5
+    distance = (np.arange(n) - 50) * cell_size
+    profile = 1000 + 20*np.exp(-distance**2 / 50)
+    dem = np.broadcast_to(np.expand_dims(profile, 1 - axis), (n, n))
+    grids = Attributes(dem, resolution=n, projection='WGS84',
+                       side_len=n*cell_size, backend='numpy'
+                       ).calc_attributes()
+    kwargs = dict(local_timezone='America/Los_Angeles', date_str='20191222',
+                  lat_lon=(37.643, -119.029), sun_backend='noaa')
+    shaded = Correction(grids, horizons=Horizons(dem, cell_size), **kwargs)
+    unshaded = Correction(grids, **kwargs)
+    if time is None:
+        time = int(np.argmin(shaded.sunposition_df['altitude'].to_numpy()))
+
+    bare = unshaded.calc_correction_onetime(time)
+    cast = (shaded.calc_correction_onetime(time) == 0) & (bare != 0)
+    # signed distance of each cell from the ridge, towards the sun
+    towards_sun = sun_side * (np.indices(dem.shape)[axis] - 50)
+    assert bare[towards_sun > 0].mean() > bare[towards_sun < 0].mean()
+    assert cast.any()
+    assert np.all(towards_sun[cast] < 0)
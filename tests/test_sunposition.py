@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from correction import Correction
+from sunposition import noaa_sunposition, pysolar_sunposition
+
+def _samples(n=300, seed=0):
+    # instants and sites across the range noaa_sunposition is validated
+    # for
+    rng = np.random.default_rng(seed)
+    start = np.datetime64('1950-01-01', 's').astype('int64')
+    end = np.datetime64('2090-01-01', 's').astype('int64')
+    seconds = rng.integers(start, end, n)
+    lats = rng.uniform(-35, 65, n)
+    lons = rng.uniform(-180, 180, n)
+    return seconds.astype('datetime64[s]'), lats, lons
+
+# pysolar warns that its leap-second table ends before 2090
+@pytest.mark.filterwarnings('ignore:Leap seconds')
+def test_noaa_agrees_with_pysolar():
+    pytest.importorskip('pysolar')
+    times, lats, lons = _samples()
+    compared = 0
+    for time, lat, lon in zip(times, lats, lons):
+        altitude, azimuth = noaa_sunposition([time], lat, lon)
+        if altitude[0] <= 0:
+            continue
+        ref_altitude, ref_azimuth = pysolar_sunposition([time], lat, lon)
+        assert abs(altitude[0] - ref_altitude[0]) < 0.03
+        if ref_altitude[0] < 85:
+            diff = (azimuth[0] - ref_azimuth[0] + 180) % 360 - 180
+            assert abs(diff) < 0.15
+        compared += 1
+    assert compared > 100
+
+SITES = [
+    ('America/Los_Angeles', '20190623', (37.643, -119.029)),
+    ('America/Los_Angeles', '20191222', (37.643, -119.029)),
+    ('Africa/Johannesburg', '20190623', (-33.9, 18.4)),
+    ('Europe/Oslo', '20190320', (69.6, 18.9)),
+]
+
+def _sun_table(site, **kwargs):
+    grids = (np.zeros((2, 2)), np.zeros((2, 2)))
+    local_timezone, date_str, lat_lon = site
+    return Correction(grids, local_timezone, date_str, lat_lon,
+                      sun_backend='noaa', **kwargs)
+
+@pytest.mark.parametrize('site', SITES)
+def test_interpolated_sun_positions(site):
+    # hourly nodes against the exact ephemeris at every minute
+    interpolated = _sun_table(site, time_step='1min', ephemeris_step='1h')
+    exact = _sun_table(site, time_step='1min', ephemeris_step='1min')
+    df, ref = interpolated.sunposition_df, exact.sunposition_df
+    assert len(df) == len(ref)
+    assert (df['local_timestamps'].to_numpy()
+            == ref['local_timestamps'].to_numpy()).all()
+
+    # the altitude column holds the zenith
+    np.testing.assert_allclose(df['altitude'], ref['altitude'], rtol=0,
+                               atol=2e-6)
+    azimuth = (df['azimuth'] - ref['azimuth'] + 180) % 360 - 180
+    high = ref['altitude'] < 2
+    assert np.abs(azimuth[~high]).max() < 1e-5
+    if high.any():
+        assert np.abs(azimuth[high]).max() < 2e-4
+
+@pytest.mark.parametrize('site', SITES)
+def test_sunlit_intervals_bracket_the_horizon(site):
+    correct = _sun_table(site, ephemeris_step='1h')
+    lat, lon = site[2]
+    for sunrise, sunset in correct.daylight:
+        for instant, sign in ((sunrise, 1), (sunset, -1)):
+            utc = instant.tz_convert('UTC').tz_localize(None)
+            before, after = noaa_sunposition(
+                np.array([utc - pd.Timedelta('1s'), utc + pd.Timedelta('1s')],
+                         dtype='datetime64[ns]'), lat, lon
+            )[0]
+            assert sign*before < 0 < sign*after
+
+def test_polar_day():
+    correct = _sun_table(('Europe/Oslo', '20190623', (78.2, 15.6)))
+    assert len(correct.sunposition_df) == 96
+    (sunrise, sunset), = correct.daylight
+    assert sunrise == correct._day_start
+    assert sunset - sunrise == pd.Timedelta('1D')
+
+def test_polar_night():
+    correct = _sun_table(('Europe/Oslo', '20191222', (78.2, 15.6)))
+    assert len(correct.sunposition_df) == 0
+    assert correct.daylight == []
+    assert correct.calc_correction_fullday().shape == (0, 2, 2)
@@ -0,0 +1,28 @@
+import numpy as np
+
+from attributes import Attributes
+from correction import Correction
+from horizon import Horizons
+from tiling import TiledCorrection
+
+def test_tiled_matches_whole_grid(sample_dem, tmp_path):
+    dem, cell_size = sample_dem
+    dem = dem.copy()
+    dem[100:130, 60:140] = -9999
+    dem_path = tmp_path / 'dem.npy'
+    np.save(dem_path, dem)
+    side_len = dem.shape[0] * cell_size
+    kwargs = dict(local_timezone='America/Los_Angeles', date_str='20190623',
+                  lat_lon=(37.643, -119.029), sun_backend='noaa')
+
+    tiled = TiledCorrection(str(dem_path), side_len, 'WGS84', tile_size=64,
+                            horizon_bins=16, **kwargs)
+    tiled.run(str(tmp_path / 'tiles'))
+    stack = np.load(tmp_path / 'tiles' / 'correction_stack.npy')
+
+    grids = Attributes(dem, resolution=dem.shape[0], projection='WGS84',
+                       side_len=side_len, backend='numpy').calc_attributes()
+    whole = Correction(grids, horizons=Horizons(dem, cell_size, n_bins=16),
+                       **kwargs)
+    expected = np.moveaxis(whole.calc_correction_fullday(), 0, -1)
+    assert np.array_equal(stack, expected)
@@ -0,0 +1,190 @@
+import os
+
+import numpy as np
+
+from attributes import Attributes
+from correction import Correction
+from horizon import Horizons
+
+def iter_tiles(shape, tile_size, halo=1):
+    '''
+    Yields the tiles covering a grid of the given shape.
+
+    Returns
+    =======
+    (inner, outer, crop) : tuple of slice pairs
+        inner is the tile's extent in the full grid, outer is that
+        extent grown by halo cells (clipped at the grid's edges), and
+        crop selects inner from an array read through outer.
+    '''
+    rows, cols = shape
+    for r0 in range(0, rows, tile_size):
+        for c0 in range(0, cols, tile_size):
+            r1, c1 = min(r0 + tile_size, rows), min(c0 + tile_size, cols)
+            hr0, hc0 = max(r0 - halo, 0), max(c0 - halo, 0)
+            hr1, hc1 = min(r1 + halo, rows), min(c1 + halo, cols)
+
+            inner = (slice(r0, r1), slice(c0, c1))
+            outer = (slice(hr0, hr1), slice(hc0, hc1))
+            crop = (slice(r0 - hr0, r1 - hr0), slice(c0 - hc0, c1 - hc0))
+            yield inner, outer, crop
+
+class TiledCorrection():
+    '''
+    Runs the Attributes and Correction pipeline over a DEM tile by tile,
+    so that the memory of slope, aspect and the correction stack is
+    bounded by tile_size rather than by the size of the DEM. The DEM is
+    opened with mmap_mode and every output is streamed into an on-disk
+    .npy file.
+
+    Slope and aspect use a 3x3 stencil, so each tile is read with a
+    one-cell halo and cropped afterwards; the results are identical to
+    processing the whole grid at once. Horizons see the whole DEM, so
+    they are computed over it one azimuth at a time (holding a few
+    rasters, rather than one per azimuth) and each tile reads its
+    window of them. Each azimuth still needs about 12 times the DEM's
+    size (as float64) in memory, so DEMs must fit in RAM several times
+    over even when tiled.
+    '''
+    def __init__(self, dem_path, side_len, projection, local_timezone,
+                 date_str, lat_lon, tile_size=1024, backend='numpy',
+                 sun_backend='noaa', dtype=np.float64, time_step='15min',
+                 ephemeris_step='15min', horizon_bins=0):
+        '''
+        Parameters
+        ==========
+        dem_path : str
+            path to a 2D .npy elevation grid
+        tile_size : int
+            side length, in cells, of the tiles processed at once
+        horizon_bins : int
+            azimuth bins for horizon angles and cast shadows (0
+            disables shadowing), as Horizons' n_bins
+
+        The remaining parameters are passed through to Attributes and
+        Correction.
+        '''
+        self.dem_path = dem_path
+        self.side_len = side_len
+        self.projection = projection
+        self.local_timezone = local_timezone
+        self.date_str = date_str
+        self.lat_lon = lat_lon
+        self.tile_size = tile_size
+        self.backend = backend
+        self.sun_backend = sun_backend
+        self.dtype = np.dtype(dtype)
+        self.time_step = time_step
+        self.ephemeris_step = ephemeris_step
+        self.horizon_bins = horizon_bins
+
+    def _calc_tile_attributes(self, elevation, outer, crop):
+        attributes = Attributes(
+                np.asarray(elevation[outer]),
+                resolution=elevation.shape[0],
+                projection=self.projection,
+                side_len=self.side_len,
+                backend=self.backend,
+                dtype=self.dtype
+        )
+        slope, aspect = attributes.calc_attributes()
+        return slope[crop], aspect[crop]
+
+    @staticmethod
+    def _open_memmap(out_dir, name, dtype, shape):
+        return np.lib.format.open_memmap(
+            os.path.join(out_dir, f'{name}.npy'), mode='w+', dtype=dtype,
+            shape=shape
+        )
+
+    def calc_terrain(self, out_dir):
+        '''
+        Writes slope.npy and aspect.npy, and horizons.npy with
+        horizon_bins, to out_dir. Returns (slope, aspect, horizons),
+        memory-mapped from those files, horizons being a Horizons or
+        None. They depend only on the DEM, so may be passed to run for
+        every date.
+        '''
+        os.makedirs(out_dir, exist_ok=True)
+        elevation = np.load(self.dem_path, mmap_mode='r')
+
+        slope = aspect = None
+        for inner, outer, crop in iter_tiles(elevation.shape, self.tile_size):
+            tile_slope, tile_aspect = self._calc_tile_attributes(
+                elevation, outer, crop
+            )
+            if slope is None:
+                slope = self._open_memmap(out_dir, 'slope', tile_slope.dtype,
+                                          elevation.shape)
+                aspect = self._open_memmap(out_dir, 'aspect',
+                                           tile_aspect.dtype, elevation.shape)
+            slope[inner] = tile_slope
+            aspect[inner] = tile_aspect
+
+        horizons = None
+        if self.horizon_bins:
+            cell_size = self.side_len / elevation.shape[0]
+            angles = self._open_memmap(out_dir, 'horizons', np.float64,
+                                       (self.horizon_bins, *elevation.shape))
+            horizons = Horizons(elevation, cell_size,
+                                n_bins=self.horizon_bins, out=angles)
+
+        slope.flush()
+        aspect.flush()
+        if horizons is not None:
+            horizons.angles.flush()
+        return slope, aspect, horizons
+
+    def run(self, out_dir, terrain=None, time_major=False):
+        '''
+        Writes correction_stack.npy to out_dir, in the (rows, cols, time)
+        layout of Interact.export, or with time_major in the (time,
+        rows, cols) layout of Correction.calc_correction_fullday, which
+        keeps each timestep contiguous on disk. Returns the Correction,
+        whose sunposition_df describes the time axis.
+
+        terrain is the (slope, aspect, horizons) of the DEM from
+        calc_terrain, if already computed, e.g. for another date;
+        otherwise calc_terrain(out_dir) is run first, also writing
+        slope.npy and aspect.npy.
+        '''
+        os.makedirs(out_dir, exist_ok=True)
+        if terrain is None:
+            terrain = self.calc_terrain(out_dir)
+        slope, aspect, horizons = terrain
+        rows, cols = slope.shape
+
+        correct = None
+        for inner, _, _ in iter_tiles(slope.shape, self.tile_size):
+            grids = (np.asarray(slope[inner]), np.asarray(aspect[inner]))
+            window = None if horizons is None else horizons.window(inner)
+
+            if correct is None:
+                correct = Correction(
+                        attribute_grids=grids,
+                        local_timezone=self.local_timezone,
+                        date_str=self.date_str,
+                        lat_lon=self.lat_lon,
+                        sun_backend=self.sun_backend,
+                        dtype=self.dtype,
+                        horizons=window,
+                        time_step=self.time_step,
+                        ephemeris_step=self.ephemeris_step
+                )
+                n_times = correct.sunposition_df.shape[0]
+                shape = ((n_times, rows, cols) if time_major
+                         else (rows, cols, n_times))
+                out_stack = self._open_memmap(out_dir, 'correction_stack',
+                                              self.dtype, shape)
+            else:
+                correct.horizons = window
+                correct.attribute_grids = grids
+
+            stack = correct.calc_correction_fullday()
+            if time_major:
+                out_stack[(slice(None), *inner)] = stack
+            else:
+                out_stack[inner] = np.moveaxis(stack, 0, -1)
+
+        out_stack.flush()
+        return correct